@@ -0,0 +1,225 @@
+import asyncio
+import os
+import signal
+import subprocess
+import time
+from enum import Enum, auto
+
+from commands import LoweringError
+from computer import (
+    CommandFailure,
+    ComputerProcess,
+    ShellInfo,
+    getShell,
+    parseShellSpecification,
+)
+from facts import Facts
+from output import CHUNK_SIZE, CapturedOutputSink
+from parsing import CommandType, Parser
+from resolving import resolveInstructions
+from running import (
+    checkStepKeepsNoState,
+    getCommandForInstruction,
+    isBuiltin,
+    runBuiltin,
+)
+from tokenization import Tokenizer
+
+
+class StepStatus(Enum):
+    Succeeded = auto()
+    Failed = auto()
+    TimedOut = auto()
+
+
+class StepResult:
+    """
+    What one step of a script did.
+    """
+
+    def __init__(
+        self,
+        line: int,
+        command: str,
+        status: StepStatus,
+        returnCode: int | None = None,
+        stdout: str = "",
+        stderr: str = "",
+        duration: float = 0.0,
+    ):
+        self.line: int = line  # counting from 1
+        self.command: str = command
+        self.status: StepStatus = status
+        self.returnCode: int | None = returnCode  # None if it never finished
+        self.stdout: str = stdout
+        self.stderr: str = stderr
+        self.duration: float = duration  # seconds
+
+
+class ScriptResult:
+    """
+    What a whole script did, step by step. A run stops at the
+    first step that doesn't succeed, so that's always the last one.
+    """
+
+    def __init__(self, steps: list[StepResult], duration: float = 0.0):
+        self.steps: list[StepResult] = steps
+        self.duration: float = duration  # seconds
+
+    @property
+    def succeeded(self):
+        return all(step.status is StepStatus.Succeeded for step in self.steps)
+
+    @property
+    def failedStep(self):
+        if self.steps and self.steps[-1].status is not StepStatus.Succeeded:
+            return self.steps[-1]
+        return None
+
+
+class AsyncComputerProcess(ComputerProcess):
+    """
+    A ComputerProcess for asyncio. Its commands run through
+    asyncio.create_subprocess_exec, so one event loop can wait
+    on lots of them at once, without any threads.
+    """
+
+    async def run(
+        self, command: str, cwd: str | None = None, timeout: float | None = None
+    ):
+        """
+        Runs a command, copying its output into self.output. Returns
+        its exit code, or None if it took longer than timeout seconds.
+        If the task running it is cancelled, so is the command.
+        """
+        executable, arguments = self.getProcessArguments(command)
+        process = await asyncio.create_subprocess_exec(
+            *arguments,
+            executable=executable,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            # so the command's own children can be stopped along with it
+            start_new_session=os.name == "posix",
+        )
+        try:
+            returnCode = await asyncio.wait_for(self.follow(process), timeout)
+        except asyncio.TimeoutError:
+            await stopProcess(process)
+            return None
+        except asyncio.CancelledError:
+            await stopProcess(process)
+            raise
+        if returnCode < 0 and executable is not None:
+            returnCode = 128 - returnCode  # how a shell reports a signal
+        return returnCode
+
+    async def follow(self, process: asyncio.subprocess.Process):
+        await asyncio.gather(self.pump(process.stdout), self.pump(process.stderr, True))
+        return await process.wait()
+
+    async def pump(self, stream: asyncio.StreamReader, isError: bool = False):
+        while chunk := await stream.read(CHUNK_SIZE):
+            self.output.write(chunk, isError)
+
+
+async def stopProcess(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+    await process.wait()
+
+
+async def runScript(
+    text: str,
+    shell: ShellInfo | str | None = None,
+    cwd: str | None = None,
+    stepTimeout: float | None = None,
+    facts: Facts | None = None,
+):
+    """
+    Runs a script's text in the current event loop, and returns
+    a ScriptResult. shell is a ShellInfo or a specification like
+    "bash", and stepTimeout limits how long each step can take.
+    Runs on the same host can share their facts.
+
+    Every step runs in a shell of its own, so a "$" line that ends
+    by changing the shell's state, like "$ cd folder", fails.
+    Cancelling the task stops whatever step is running.
+    """
+    if isinstance(shell, str):
+        shell = parseShellSpecification(shell)
+    shell = shell or getShell()
+    workingDirectory = os.path.abspath(cwd or os.getcwd())
+
+    steps: list[StepResult] = []
+    start = time.perf_counter()
+    instructions = Parser(Tokenizer(text).iterTokens()).iterInstructions()
+    facts = facts or Facts(shell)
+    resolvedInstructions = resolveInstructions(instructions, facts=facts)
+    while True:
+        try:
+            instruction = next(resolvedInstructions, None)
+        except LoweringError as error:
+            # a condition that can't be decided fails as a step of its own
+            steps.append(
+                StepResult(error.line or 0, "", StepStatus.Failed, stderr=f"{error}\n")
+            )
+            break
+        if instruction is None:
+            break
+        if instruction.commandType is CommandType.Ignore:
+            continue
+
+        output = CapturedOutputSink()
+        computerProcess = AsyncComputerProcess(output, shell)
+        stepStart = time.perf_counter()
+        status = StepStatus.Succeeded
+        returnCode = 0
+
+        if isBuiltin(instruction, computerProcess):
+            command = instruction.reference
+            try:
+                workingDirectory = runBuiltin(instruction, workingDirectory, output)
+            except CommandFailure as failure:
+                status, returnCode = StepStatus.Failed, failure.returnCode
+                output.write(f"{failure.output}\n".encode(), True)
+        else:
+            try:
+                command = getCommandForInstruction(instruction, shell.type)
+                checkStepKeepsNoState(instruction, command)
+            except LoweringError as error:
+                command, status, returnCode = "", StepStatus.Failed, None
+                output.write(f"{error}\n".encode(), True)
+            else:
+                if command == "":
+                    continue
+                returnCode = await computerProcess.run(
+                    command, workingDirectory, stepTimeout
+                )
+                if returnCode is None:
+                    status = StepStatus.TimedOut
+                elif returnCode != 0:
+                    status = StepStatus.Failed
+
+        steps.append(
+            StepResult(
+                instruction.line,
+                command,
+                status,
+                returnCode,
+                output.getText(),
+                output.getText(isError=True),
+                time.perf_counter() - stepStart,
+            )
+        )
+        if status is not StepStatus.Succeeded:
+            break
+
+    return ScriptResult(steps, time.perf_counter() - start)
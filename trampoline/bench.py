@@ -0,0 +1,199 @@
+"""
+Benchmarks the tokenizer, the parser and instruction lowering on
+generated scripts of increasing size.
+
+    python bench.py [--sizes 1000,10000,100000] [--output results.json]
+                    [--compare old-results.json]
+
+Results are written as JSON, so runs from different versions can be
+compared with --compare.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from computer import ShellType
+from misc import TRAMPOLINE_VERSION
+from parsing import Parser
+from running import getCommandForInstruction
+from tokenization import Tokenizer
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+REPEATS = 3
+PHASES = ("tokenize", "parse", "lower")
+
+WORDS = ["yay", "trampoline", "hop", "bounce", "meow", "script", "shell", "repo"]
+
+
+def makeLongString(generator: random.Random):
+    return " ".join(generator.choice(WORDS) for _ in range(generator.randint(20, 60)))
+
+
+# every generator returns a list of lines
+FEATURES = {
+    "globals": lambda generator, index: [f'% value{index} "{generator.choice(WORDS)}"'],
+    "numbers": lambda generator, index: [f"% number{index} {generator.random():.4f}"],
+    "prints": lambda generator, index: [f'! print "{generator.choice(WORDS)} {index}"'],
+    "longStrings": lambda generator, index: [f'! print "{makeLongString(generator)}"'],
+    "shell": lambda generator, index: [f"$ echo {generator.choice(WORDS)} {index}"],
+    "clones": lambda generator, index: [
+        f"! clone 'https://example.com/{generator.choice(WORDS)}/{index}.git'"
+    ],
+    "navigation": lambda generator, index: [f"! navto {generator.choice(WORDS)}"],
+    "comments": lambda generator, index: [
+        f"/ {' '.join(generator.choice(WORDS) for _ in range(8))}"
+    ],
+    "blocks": lambda generator, index: [
+        f"? meta.value{index} == '{generator.choice(WORDS)}':",
+        f"    $ echo {generator.choice(WORDS)}",
+        f"    ! print 'nested {index}'",
+        ";",
+    ],
+}
+
+MIXES = {
+    "mixed": list(FEATURES),
+    "longStrings": ["longStrings"],
+    "actions": ["prints", "clones", "navigation"],
+    "shell": ["shell"],
+    "comments": ["comments"],
+    "blocks": ["blocks"],
+}
+
+
+def generateScript(lineCount: int, features: list[str], seed: int = 0):
+    generator = random.Random(seed)
+    lines: list[str] = []
+    index = 0
+    while len(lines) < lineCount:
+        lines += FEATURES[generator.choice(features)](generator, index)
+        index += 1
+    return "\n".join(lines[:lineCount]) + "\n"
+
+
+def measure(function):
+    """
+    Runs function REPEATS times. Returns its fastest time in
+    seconds, its peak traced memory in bytes and its result.
+    """
+    fastest = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function()
+        fastest = min(fastest, time.perf_counter() - start)
+        del result
+
+    tracemalloc.start()
+    result = function()
+    _, peakMemory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return fastest, peakMemory, result
+
+
+def benchmarkScript(text: str):
+    lineCount = text.count("\n")
+    byteCount = len(text.encode())
+
+    tokenizeTime, tokenizePeak, tokens = measure(lambda: Tokenizer(text).getTokens())
+    parseTime, parsePeak, instructions = measure(
+        lambda: Parser(tokens).getInstructions()
+    )
+    lowerTime, lowerPeak, _ = measure(
+        lambda: [
+            getCommandForInstruction(instruction, ShellType.Bash)
+            for instruction in instructions
+        ]
+    )
+
+    def describe(seconds: float, peakMemory: int):
+        return {
+            "seconds": seconds,
+            "linesPerSecond": lineCount / seconds if seconds else None,
+            "bytesPerSecond": byteCount / seconds if seconds else None,
+            "peakMemoryBytes": peakMemory,
+        }
+
+    return {
+        "lines": lineCount,
+        "bytes": byteCount,
+        "tokens": len(tokens),
+        "instructions": len(instructions),
+        "tokenize": describe(tokenizeTime, tokenizePeak),
+        "parse": describe(parseTime, parsePeak),
+        "lower": describe(lowerTime, lowerPeak),
+    }
+
+
+def compareResults(results: dict, oldResults: dict):
+    """
+    Prints how each phase's time changed since oldResults.
+    """
+    oldRuns = {(run["mix"], run["lines"]): run for run in oldResults["runs"]}
+    print(f"\n/ compared to v{oldResults['version']}:", file=sys.stderr)
+    for run in results["runs"]:
+        oldRun = oldRuns.get((run["mix"], run["lines"]))
+        if oldRun is None:
+            continue
+        changes = []
+        for phase in PHASES:
+            ratio = run[phase]["seconds"] / oldRun[phase]["seconds"]
+            changes.append(f"{phase} {ratio:.2f}x")
+        print(
+            f"- {run['mix']} @ {run['lines']} lines: {', '.join(changes)}",
+            file=sys.stderr,
+        )
+
+
+def main():
+    argumentParser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    argumentParser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma-separated script sizes, in lines",
+    )
+    argumentParser.add_argument(
+        "--mixes", default=",".join(MIXES), help="comma-separated feature mixes"
+    )
+    argumentParser.add_argument("--output", help="write JSON results here")
+    argumentParser.add_argument("--compare", help="JSON results to compare against")
+    arguments = argumentParser.parse_args()
+
+    results = {
+        "version": TRAMPOLINE_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": [],
+    }
+
+    for mix in arguments.mixes.split(","):
+        for size in [int(size) for size in arguments.sizes.split(",")]:
+            run = {"mix": mix, **benchmarkScript(generateScript(size, MIXES[mix]))}
+            results["runs"].append(run)
+
+            summary = ", ".join(
+                f"{phase} {run[phase]['seconds'] * 1000:.1f}ms"
+                f" ({run[phase]['peakMemoryBytes'] / 1024 / 1024:.1f}MiB)"
+                for phase in PHASES
+            )
+            print(f"/ {mix} @ {size} lines: {summary}", file=sys.stderr)
+
+    if arguments.output:
+        with open(arguments.output, "w") as outputFile:
+            json.dump(results, outputFile, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if arguments.compare:
+        with open(arguments.compare) as compareFile:
+            compareResults(results, json.load(compareFile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import hashlib
+import io
+import marshal
+import os
+from pathlib import Path
+from typing import Iterable
+
+from misc import TRAMPOLINE_VERSION, getCacheDirectory
+from parsing import Argument, ArgumentType, CommandType, Instruction, ReferenceType
+
+CACHE_MAGIC = b"YAYC\x09"
+CACHE_SUFFIX = ".yayc"
+CACHE_MAX_SIZE = 64 * 1024 * 1024  # bytes
+CACHE_BATCH_SIZE = 1024  # instructions written to the cache together
+
+# instructions kept in memory, by script hash. Only the server fills
+# it in, so the runs it forks don't even have to read the cache
+warmInstructions: dict[str, list[Instruction]] = {}
+
+
+def getScriptHash(text: str):
+    return getDataHash([text.encode()])
+
+
+def getDataHash(blocks: Iterable[bytes]):
+    """
+    Hashes a script's raw bytes, a block at a time.
+    """
+    digest = hashlib.sha256(TRAMPOLINE_VERSION.encode())
+    digest.update(b"\0")
+    digest.update(CACHE_MAGIC)  # what's cached changes with the format
+    for block in blocks:
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def encodeInstruction(instruction: Instruction):
+    return (
+        instruction.commandType.value,
+        instruction.referenceType.value if instruction.referenceType else 0,
+        instruction.reference,
+        tuple(encodeArgument(argument) for argument in instruction.arguments),
+        instruction.line,
+        instruction.slot,
+    )
+
+
+def encodeArgument(argument: Argument):
+    if isinstance(argument.value, list):
+        return (
+            argument.type.value,
+            [encodeInstruction(instruction) for instruction in argument.value],
+            argument.slot,
+        )
+    return (argument.type.value, argument.value, argument.slot)
+
+
+def decodeInstruction(encoded: tuple):
+    commandType, referenceType, reference, arguments, line, slot = encoded
+    return Instruction(
+        commandType=CommandType(commandType),
+        referenceType=ReferenceType(referenceType) if referenceType else None,
+        reference=reference,
+        arguments=[decodeArgument(argument) for argument in arguments],
+        line=line,
+        slot=slot,
+    )
+
+
+def decodeArgument(encoded: tuple):
+    type, value, slot = encoded
+    if isinstance(value, list):
+        value = [decodeInstruction(instruction) for instruction in value]
+    return Argument(type=ArgumentType(type), value=value, slot=slot)
+
+
+def writeAtomically(path: Path, data: bytes):
+    """
+    Writes data to path through a temporary file, so readers
+    never see a half-written file.
+    """
+    import tempfile
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fileDescriptor, temporaryPath = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fileDescriptor, "wb") as temporaryFile:
+            temporaryFile.write(data)
+        os.replace(temporaryPath, path)
+    except OSError:
+        os.unlink(temporaryPath)
+        raise
+
+
+def evictLeastRecentlyUsed(directory: Path, pattern: str, maxSize: int):
+    """
+    Removes the least recently used files matching pattern
+    until they fit in maxSize bytes.
+    """
+    entries = []
+    totalSize = 0
+    for path in directory.glob(pattern):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        totalSize += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if totalSize <= maxSize:
+            break
+        try:
+            path.unlink()
+            totalSize -= size
+        except OSError:
+            pass
+
+
+class InstructionCache:
+    """
+    Keeps parsed instructions around so unchanged scripts
+    don't have to be tokenized and parsed again.
+    """
+
+    def __init__(
+        self, directory: Path | None = None, maxSize: int = CACHE_MAX_SIZE
+    ) -> None:
+        self.directory: Path = directory or getCacheDirectory()
+        self.maxSize: int = maxSize
+
+    def getPath(self, scriptHash: str):
+        return self.directory / f"{scriptHash}{CACHE_SUFFIX}"
+
+    def load(self, scriptHash: str):
+        """
+        Returns the cached instructions for scriptHash, or
+        None if there aren't any.
+        """
+        instructions = warmInstructions.get(scriptHash)
+        if instructions is not None:
+            return instructions
+
+        path = self.getPath(scriptHash)
+        try:
+            data = path.read_bytes()
+            if not data.startswith(CACHE_MAGIC):
+                return None
+            entries = io.BytesIO(data)
+            entries.seek(len(CACHE_MAGIC))
+            instructions = []
+            while entries.tell() < len(data):
+                instructions += map(decodeInstruction, marshal.load(entries))
+            os.utime(path)  # mark as recently used
+        except Exception:
+            return None
+        return instructions
+
+    def store(self, scriptHash: str, instructions: Iterable[Instruction]):
+        for _ in self.cacheInstructions(scriptHash, instructions):
+            pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the
+        cache fits in self.maxSize.
+        """
+        evictLeastRecentlyUsed(self.directory, f"*{CACHE_SUFFIX}", self.maxSize)
+
+    def cacheInstructions(self, scriptHash: str, instructions: Iterable[Instruction]):
+        """
+        Yields instructions as they come, writing them out a batch
+        at a time, so a long script is never held in memory whole.
+        The entry only shows up once they've all been read.
+        """
+        import tempfile
+
+        cacheFile = None
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fileDescriptor, temporaryPath = tempfile.mkstemp(
+                dir=self.directory, suffix=".tmp"
+            )
+            cacheFile = os.fdopen(fileDescriptor, "wb")
+            cacheFile.write(CACHE_MAGIC)
+        except OSError:
+            pass  # a cache that can't be written is just a slower cache
+
+        try:
+            batch = []
+            for instruction in instructions:
+                if cacheFile is not None:
+                    batch.append(encodeInstruction(instruction))
+                    if len(batch) == CACHE_BATCH_SIZE:
+                        cacheFile = writeBatch(cacheFile, batch)
+                        batch = []
+                yield instruction
+
+            if cacheFile is not None and writeBatch(cacheFile, batch) is not None:
+                cacheFile.close()
+                os.replace(temporaryPath, self.getPath(scriptHash))
+                cacheFile = None
+                self.evict()
+        except OSError:
+            pass
+        finally:
+            if cacheFile is not None:
+                # left unfinished, by an error or a run that stopped early
+                cacheFile.close()
+                try:
+                    os.unlink(temporaryPath)
+                except OSError:
+                    pass
+
+
+def writeBatch(cacheFile, batch: list):
+    """
+    Writes a batch of encoded instructions to cacheFile. Returns
+    cacheFile, or None if it couldn't be written to.
+    """
+    try:
+        cacheFile.write(marshal.dumps(batch))
+    except OSError:
+        cacheFile.close()
+        return None
+    return cacheFile
@@ -0,0 +1,147 @@
+"""
+Checks that clone passes depth and filter along to git, and that
+mirror keeps a local mirror up to date and clones from it, all
+without a network: the repository is a bare one in a temporary
+folder, cloned over file://.
+
+    python clonecheck.py
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+COMMITS = 3
+
+here = Path(__file__).resolve().parent
+
+
+def git(*arguments: str, cwd: Path):
+    return subprocess.run(
+        ["git", *arguments], cwd=cwd, capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def makeRemote(directory: Path):
+    """
+    Makes a bare repository with a few commits, and returns the
+    work tree the commits are made in.
+    """
+    remote = directory / "remote.git"
+    work = directory / "work"
+    git("init", "--quiet", "--bare", str(remote), cwd=directory)
+    git("config", "uploadpack.allowFilter", "true", cwd=remote)
+    git("symbolic-ref", "HEAD", "refs/heads/main", cwd=remote)
+    git("init", "--quiet", str(work), cwd=directory)
+    git("remote", "add", "origin", str(remote), cwd=work)
+    for commit in range(COMMITS):
+        addCommit(work, commit)
+    return work
+
+
+def addCommit(work: Path, number: int):
+    (work / f"file{number}.txt").write_text(f"commit {number}\n")
+    git("add", ".", cwd=work)
+    git("commit", "--quiet", "-m", f"commit {number}", cwd=work)
+    git("push", "--quiet", "origin", "HEAD:main", cwd=work)
+
+
+def runScript(directory: Path, name: str, text: str, environment: dict[str, str]):
+    scriptPath = directory / f"{name}.yay"
+    scriptPath.write_text(text)
+    return subprocess.run(
+        [
+            sys.executable,
+            str(here / "main.py"),
+            "run",
+            str(scriptPath),
+            "--stream",
+            "--no-cache",
+            "--no-server",
+        ],
+        cwd=directory / name,
+        env=environment,
+        capture_output=True,
+        text=True,
+    )
+
+
+def main():
+    failures: list[str] = []
+
+    def check(name: str, passed: bool, detail: str = ""):
+        if passed:
+            print(f"{name}: ok")
+        else:
+            print(f"{name}: failed! {detail}".rstrip())
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory() as temporaryDirectory:
+        directory = Path(temporaryDirectory)
+        cacheDirectory = directory / "cache"
+        environment = {
+            **os.environ,
+            "YAY_CACHE_DIR": str(cacheDirectory),
+            "GIT_AUTHOR_NAME": "yay",
+            "GIT_AUTHOR_EMAIL": "yay@example.com",
+            "GIT_COMMITTER_NAME": "yay",
+            "GIT_COMMITTER_EMAIL": "yay@example.com",
+        }
+        os.environ.update(environment)  # for the commits made here
+
+        work = makeRemote(directory)
+        url = (directory / "remote.git").as_uri()
+        for name in ["shallow", "partial", "mirror", "mirrorAgain", "bad"]:
+            (directory / name).mkdir()
+
+        result = runScript(
+            directory, "shallow", f"! clone '{url}' depth 1\n", environment
+        )
+        clone = directory / "shallow" / "remote"
+        check("depth", result.returncode == 0, result.stdout + result.stderr)
+        if result.returncode == 0:
+            commits = git("rev-list", "--count", "HEAD", cwd=clone)
+            check("depth: one commit", commits == "1", f"({commits} commits)")
+
+        result = runScript(
+            directory,
+            "partial",
+            f"! clone '{url}' filter 'blob:none' depth 2\n",
+            environment,
+        )
+        clone = directory / "partial" / "remote"
+        check("filter", result.returncode == 0, result.stdout + result.stderr)
+        if result.returncode == 0:
+            partialFilter = git("config", "remote.origin.partialclonefilter", cwd=clone)
+            commits = git("rev-list", "--count", "HEAD", cwd=clone)
+            check("filter: partial", partialFilter == "blob:none", partialFilter)
+            check("filter: two commits", commits == "2", f"({commits} commits)")
+
+        mirrorScript = f"! clone '{url}' mirror\n"
+        result = runScript(directory, "mirror", mirrorScript, environment)
+        mirrors = list((cacheDirectory / "mirrors").glob("*.git"))
+        check("mirror", result.returncode == 0, result.stdout + result.stderr)
+        check("mirror: kept", len(mirrors) == 1)
+
+        addCommit(work, COMMITS)  # the mirror has to catch up on this one
+        result = runScript(directory, "mirrorAgain", mirrorScript, environment)
+        clone = directory / "mirrorAgain" / "remote"
+        check("mirror again", result.returncode == 0, result.stdout + result.stderr)
+        if result.returncode == 0:
+            commits = git("rev-list", "--count", "HEAD", cwd=clone)
+            check(
+                "mirror: updated", commits == str(COMMITS + 1), f"({commits} commits)"
+            )
+            alternates = clone / ".git" / "objects" / "info" / "alternates"
+            check("mirror: dissociated", not alternates.exists())
+
+        result = runScript(directory, "bad", f"! clone '{url}' depth\n", environment)
+        check("depth without a number fails", result.returncode != 0)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
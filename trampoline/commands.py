@@ -1,4 +1,18 @@
-from computer import ShellType
+import hashlib
+import re
+
+from computer import MultiShellCommand, ShellType
+from misc import getCacheDirectory
+from parsing import Argument, ArgumentType
+
+MIRROR_DIRECTORY = "mirrors"
+MIRROR_NAME_PATTERN = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+class LoweringError(Exception):
+    def __init__(self, message: str, line: int | None = None):
+        super().__init__(message)
+        self.line: int | None = line  # if it's known
 
 
 def formatStringForShell(shellType, string):
@@ -14,34 +28,177 @@ def formatStringForShell(shellType, string):
             return string.replace('"', '""').replace("%", "%%")
 
 
+class Operation:
+    """
+    An operation that can be lowered into a shell command. Its
+    templates take the operation's argument as {argument}, and
+    a template of None means the shell can't do it.
+    """
+
+    def __init__(self, templates: MultiShellCommand, quoteArgument: bool = True):
+        self.templates: MultiShellCommand = templates
+        self.quoteArgument: bool = quoteArgument
+
+        # split once into what goes before and after the argument
+        self.templateParts: dict[ShellType, tuple[str, str]] = {}
+        for shellType, template in templates.byShellType.items():
+            if template is not None:
+                before, _, after = template.partition("{argument}")
+                self.templateParts[shellType] = (before, after)
+
+    def lowerArguments(self, shellType: ShellType, arguments: list[Argument]):
+        """
+        Lowers the operation with an instruction's arguments, which
+        are all joined together into one by default.
+        """
+        text = ""
+        for argument in arguments:
+            if isinstance(argument.value, str):
+                text += argument.value
+        return self.lower(shellType, text)
+
+    def lower(self, shellType: ShellType, argument: str):
+        parts = self.templateParts.get(shellType)
+        if parts is None:
+            return None
+        if self.quoteArgument:
+            argument = formatStringForShell(shellType, argument)
+        return parts[0] + argument + parts[1]
+
+
+class CloneOperation(Operation):
+    """
+    Clones a repository. It understands a few words after the URL:
+
+        ! clone 'https://example.com/repo.git' depth 1 filter 'blob:none' mirror
+
+    depth and filter are passed along to git clone. mirror keeps
+    a bare mirror of the repository in the cache, updates it, and
+    clones from it, so only new objects come over the network.
+    """
+
+    def lowerArguments(self, shellType: ShellType, arguments: list[Argument]):
+        url = ""
+        options: list[str] = []
+        mirror = False
+
+        remainingArguments = iter(arguments)
+        for argument in remainingArguments:
+            if argument.type is not ArgumentType.Reference:
+                url += argument.value
+                continue
+            match argument.value:
+                case "mirror":
+                    mirror = True
+                case "depth":
+                    depthArgument = next(remainingArguments, None)
+                    if depthArgument is None or not depthArgument.value.isdigit():
+                        raise LoweringError("clone depth needs a whole number")
+                    options.append(f"--depth {int(depthArgument.value)}")
+                case "filter":
+                    filterArgument = next(remainingArguments, None)
+                    if filterArgument is None:
+                        raise LoweringError(
+                            "clone filter needs a filter, like 'blob:none'"
+                        )
+                    options.append(
+                        "--filter="
+                        + formatStringForShell(shellType, filterArgument.value)
+                    )
+                case word:
+                    url += word  # like any other argument
+
+        if mirror:
+            return self.lowerMirrored(shellType, url, options)
+        if not options:
+            return self.lower(shellType, url)
+        parts = self.templateParts.get(shellType)
+        if parts is None:
+            return None
+        return (
+            parts[0]
+            + " ".join([*options, formatStringForShell(shellType, url)])
+            + parts[1]
+        )
+
+    def lowerMirrored(self, shellType: ShellType, url: str, options: list[str]):
+        mirrorPath = formatPathForShell(shellType, str(getMirrorPath(url)))
+        quotedURL = formatStringForShell(shellType, url)
+        updateMirror = f"git --git-dir={mirrorPath} fetch --prune --quiet"
+        createMirror = f"git clone --mirror --quiet {quotedURL} {mirrorPath}"
+        clone = " ".join(
+            ["git clone --reference", mirrorPath, "--dissociate", *options, quotedURL]
+        )
+
+        match shellType:
+            case ShellType.Bash | ShellType.GenericPOSIX | ShellType.ZShell:
+                return (
+                    f"{{ if [ -d {mirrorPath} ]; then {updateMirror}; "
+                    f"else {createMirror}; fi; }} && {clone}"
+                )
+            case ShellType.WindowsCommandPrompt:
+                return (
+                    f"(if exist {mirrorPath} ({updateMirror}) "
+                    f"else ({createMirror})) && {clone}"
+                )
+
+
+def getMirrorPath(url: str):
+    """
+    Returns where the bare mirror of url is kept.
+    """
+    name = url.rstrip("/\\").rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+    name = MIRROR_NAME_PATTERN.sub("-", name.removesuffix(".git")) or "repo"
+    urlHash = hashlib.sha256(url.encode()).hexdigest()[:16]
+    return getCacheDirectory() / MIRROR_DIRECTORY / f"{name}-{urlHash}.git"
+
+
+# every operation a "!" instruction can run, by name
+OPERATIONS: dict[str, Operation] = {
+    "print": Operation(
+        MultiShellCommand(
+            powerShell="Write-Host -NoNewline {argument}",
+            bash="printf '%s' {argument}",
+            zShell="printf '%s' {argument}",
+            genericPosix="printf '%s' {argument}",
+            windowsCommandPrompt="echo {argument}",  # set /p would fail the step
+        )
+    ),
+    "navto": Operation(
+        MultiShellCommand(
+            powerShell="cd {argument}",
+            bash="cd {argument}",
+            zShell="cd {argument}",
+            genericPosix="cd {argument}",
+            windowsCommandPrompt="cd {argument}",
+        ),
+        quoteArgument=False,
+    ),
+    "clone": CloneOperation(
+        MultiShellCommand(
+            powerShell=None,
+            bash="git clone {argument}",
+            zShell="git clone {argument}",
+            genericPosix="git clone {argument}",
+            windowsCommandPrompt="git clone {argument}",
+        )
+    ),
+}
+
+
+def formatPathForShell(shellType, path: str):
+    if shellType is ShellType.WindowsCommandPrompt:
+        return '"' + formatStringForShell(shellType, path) + '"'
+    return formatStringForShell(shellType, path)
+
+
 def c_print(shellType, string):
-    match shellType:
-        case ShellType.PowerShell:
-            return f"Write-Host {formatStringForShell(shellType, string)}"
-        case ShellType.Bash | ShellType.GenericPOSIX | ShellType.ZShell:
-            return f"printf {formatStringForShell(shellType, string)}"
-        case ShellType.WindowsCommandPrompt:
-            return f"echo {formatStringForShell(shellType, string)}"
+    return OPERATIONS["print"].lower(shellType, string)
 
 
 def c_navto(shellType, path: str):
-    match shellType:
-        case (
-            ShellType.Bash
-            | ShellType.PowerShell
-            | ShellType.GenericPOSIX
-            | ShellType.ZShell
-            | ShellType.WindowsCommandPrompt
-        ):
-            return f"cd {path}"
+    return OPERATIONS["navto"].lower(shellType, path)
 
 
 def c_clone(shellType, url: str):
-    match shellType:
-        case (
-            ShellType.Bash
-            | ShellType.GenericPOSIX
-            | ShellType.ZShell
-            | ShellType.WindowsCommandPrompt
-        ):
-            return f"git clone {formatStringForShell(shellType, string=url)}"
+    return OPERATIONS["clone"].lower(shellType, url)
@@ -0,0 +1,167 @@
+import json
+import os
+from pathlib import Path
+from typing import Iterable
+
+from caching import evictLeastRecentlyUsed, writeAtomically
+from computer import ShellType
+from facts import Facts
+from misc import TRAMPOLINE_VERSION, getCacheDirectory
+from parsing import Instruction
+from running import getCommandForInstruction
+
+COMPILED_DIRECTORY = "compiled"
+COMPILED_MAX_SIZE = 64 * 1024 * 1024  # bytes
+FACTS_SUFFIX = ".facts"  # next to each script: the facts it was compiled with
+
+SHELLTYPE_SCRIPT_SUFFIX_MAP = {
+    ShellType.PowerShell: ".ps1",
+    ShellType.Bash: ".sh",
+    ShellType.ZShell: ".zsh",
+    ShellType.GenericPOSIX: ".sh",
+    ShellType.WindowsCommandPrompt: ".cmd",
+}
+
+SHELLTYPE_INTERPRETER_MAP = {
+    ShellType.Bash: "bash",
+    ShellType.ZShell: "zsh",
+    ShellType.GenericPOSIX: "sh",
+}
+
+
+def getScriptHeader(shellType: ShellType, scriptHash: str):
+    match shellType:
+        case ShellType.PowerShell:
+            return [
+                f"# compiled by yay trampoline v{TRAMPOLINE_VERSION} ({scriptHash})",
+                "$ErrorActionPreference = 'Stop'",
+            ]
+        case ShellType.WindowsCommandPrompt:
+            return [
+                "@echo off",
+                f"rem compiled by yay trampoline v{TRAMPOLINE_VERSION} ({scriptHash})",
+            ]
+        case ShellType.Bash | ShellType.ZShell | ShellType.GenericPOSIX | _:
+            return [
+                f"#!/usr/bin/env {SHELLTYPE_INTERPRETER_MAP.get(shellType, 'sh')}",
+                f"# compiled by yay trampoline v{TRAMPOLINE_VERSION} ({scriptHash})",
+                "set -e",
+            ]
+
+
+def getLinesForCommand(shellType: ShellType, command: str, line: int):
+    """
+    Returns the lines that run command and stop the script if
+    it fails, the way the other run modes do.
+    """
+    match shellType:
+        case ShellType.PowerShell:
+            return [
+                f"# line {line}",
+                command,
+                "if (-not $?) { if ($LASTEXITCODE) { exit $LASTEXITCODE }; exit 1 }",
+            ]
+        case ShellType.WindowsCommandPrompt:
+            # %errorlevel% is expanded when its own line is read,
+            # so it sees the command's exit code
+            return [
+                f"rem line {line}",
+                command,
+                "if errorlevel 1 exit /b %errorlevel%",
+            ]
+        case ShellType.Bash | ShellType.ZShell | ShellType.GenericPOSIX | _:
+            return [f"# line {line}", command]  # set -e does the stopping
+
+
+def compileInstructions(
+    instructions: Iterable[Instruction], shellType: ShellType, scriptHash: str = ""
+):
+    """
+    Lowers instructions into the text of a script file that
+    shellType can run by itself.
+    """
+    lines = getScriptHeader(shellType, scriptHash)
+    for instruction in instructions:
+        command = getCommandForInstruction(instruction, shellType)
+        if command == "":
+            continue
+        lines += getLinesForCommand(shellType, command, instruction.line)
+
+    newline = "\r\n" if shellType is ShellType.WindowsCommandPrompt else "\n"
+    return newline.join(lines) + newline
+
+
+def encodeScript(text: str, shellType: ShellType):
+    # Windows PowerShell only reads .ps1 files as UTF-8 if they have a BOM
+    encoding = "utf-8-sig" if shellType is ShellType.PowerShell else "utf-8"
+    return text.encode(encoding)
+
+
+class ScriptCache:
+    """
+    Keeps compiled scripts around, one per script and shell,
+    so unchanged scripts can be run without lowering them again.
+    """
+
+    def __init__(
+        self, directory: Path | None = None, maxSize: int = COMPILED_MAX_SIZE
+    ) -> None:
+        self.directory: Path = directory or getCacheDirectory() / COMPILED_DIRECTORY
+        self.maxSize: int = maxSize
+
+    def getPath(self, scriptHash: str, shellType: ShellType):
+        suffix = SHELLTYPE_SCRIPT_SUFFIX_MAP[shellType]
+        return self.directory / f"{scriptHash}-{shellType.name}{suffix}"
+
+    def getFactsPath(self, path: Path):
+        return path.with_name(path.name + FACTS_SUFFIX)
+
+    def load(self, scriptHash: str, shellType: ShellType, facts: Facts | None = None):
+        """
+        Returns the path of the compiled script for scriptHash
+        and shellType, or None if there isn't one. With facts, it's
+        also None if any of the facts the script was compiled with
+        are different now.
+        """
+        path = self.getPath(scriptHash, shellType)
+        factsPath = self.getFactsPath(path)
+        try:
+            if facts is not None:
+                compiledFacts = json.loads(factsPath.read_text())
+                for name, value in compiledFacts.items():
+                    if facts.get(name) != value:
+                        return None
+            os.utime(path)  # mark as recently used
+            os.utime(factsPath)
+        except (OSError, ValueError):
+            return None
+        return path
+
+    def store(
+        self,
+        scriptHash: str,
+        shellType: ShellType,
+        text: str,
+        factValues: dict[str, str] | None = None,
+    ):
+        """
+        Writes a compiled script into the cache, along with the
+        facts it was compiled with. Returns its path, or None if the
+        cache can't be written.
+        """
+        path = self.getPath(scriptHash, shellType)
+        try:
+            writeAtomically(
+                self.getFactsPath(path), json.dumps(factValues or {}).encode()
+            )
+            writeScript(path, text, shellType)
+            evictLeastRecentlyUsed(self.directory, "*-*", self.maxSize)
+        except OSError:
+            return None
+        return path
+
+
+def writeScript(path: Path, text: str, shellType: ShellType):
+    writeAtomically(path, encodeScript(text, shellType))
+    if shellType in SHELLTYPE_INTERPRETER_MAP:
+        os.chmod(path, 0o755)
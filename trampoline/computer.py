@@ -1,8 +1,11 @@
+import json
 import os
+import re
 import subprocess
 from enum import Enum, auto
 
-import shellingham
+from misc import getCacheDirectory, getShellCacheKey
+from output import CHUNK_SIZE, OutputSink
 
 
 class ShellType(Enum):
@@ -19,7 +22,184 @@ class ShellInfo:
         self.type: ShellType = name
 
 
+SHELL_NAME_SHELLTYPE_MAP = {
+    "powershell": ShellType.PowerShell,
+    "pwsh": ShellType.PowerShell,
+    "bash": ShellType.Bash,
+    "zsh": ShellType.ZShell,
+    "sh": ShellType.GenericPOSIX,
+    "posix": ShellType.GenericPOSIX,
+    "cmd": ShellType.WindowsCommandPrompt,
+}
+
+SHELL_CACHE_FILE = "shell.json"
+SHELL_CACHE_MAX_ENTRIES = 32
+
+# shells whose simple commands can skip them, and run their program directly
+DIRECT_SHELL_TYPES = {ShellType.Bash, ShellType.ZShell, ShellType.GenericPOSIX}
+# characters that mean a command needs a shell: variables, globs,
+# redirections, pipes, escapes and so on
+SHELL_METACHARACTERS = frozenset("|&;<>()$`\\*?[]{}~#!\n")
+# words only a shell understands, even if there's a program called that
+SHELL_WORDS = frozenset("""
+    . : alias bg break builtin case cd command continue declare do done elif
+    else esac eval exec exit export fc fg fi for function getopts hash if jobs
+    let local popd pushd read readonly return select set setopt shift source
+    then time trap type typeset ulimit umask unalias unset until wait while
+    """.split())
+
+# words that change the shell itself, like its directory or environment,
+# in the shells the trampoline knows
+SHELL_STATE_WORDS = frozenset("""
+    . alias cd chdir declare export hash local pop-location popd push-location
+    pushd readonly set set-location setopt shopt sl source typeset ulimit umask
+    unalias unset unsetopt
+    """.split())
+ASSIGNMENT_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+
+# programs found on PATH so far, by PATH and name
+executablePaths: dict[tuple[str, str], str | None] = {}
+
+
+def parseShellSpecification(specification: str, requirePath: bool = True):
+    """
+    Turns a specification like "bash" or "bash:/bin/bash"
+    into a ShellInfo. Without requirePath, a shell that isn't
+    installed is fine too, for when only its type matters.
+    """
+    import shutil
+
+    shellName, _, shellPath = specification.partition(":")
+    if shellName.lower() not in SHELL_NAME_SHELLTYPE_MAP:
+        raise ValueError(f"{shellName!r} isn't a shell the trampoline knows")
+
+    shellPath = shellPath or shutil.which(shellName) or ""
+    if not shellPath:
+        if requirePath:
+            raise ValueError(f"couldn't find {shellName!r}")
+        shellPath = shellName
+    return ShellInfo(shellPath, SHELL_NAME_SHELLTYPE_MAP[shellName.lower()])
+
+
+def findExecutable(name: str):
+    """
+    Returns where the program called name is on PATH, or None.
+    Each program is only looked up once.
+    """
+    searchPath = os.environ.get("PATH", os.defpath)
+    key = (searchPath, name)
+    if key not in executablePaths:
+        import shutil
+
+        executablePaths[key] = shutil.which(name, path=searchPath)
+    return executablePaths[key]
+
+
+def getLastingStateChange(command: str):
+    """
+    Returns the word a command ends with a change to the shell's
+    state with, like "cd" in "mkdir hello; cd hello", or None. A
+    change made for the commands after it on the same line, like
+    in "cd hello && make", doesn't count.
+    """
+    import shlex
+
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.escape = ""  # backslashes are separators in Windows paths
+    lexer.wordchars += "$:"
+    try:
+        words = list(lexer)
+    except ValueError:
+        return None  # an unclosed quote, which the shell can complain about
+    while words and words[-1] in (";", "}"):
+        words.pop()
+    if not words or words[-1] in ("&", ")"):
+        return None  # in the background, or in a subshell
+
+    start = len(words)
+    while start > 0 and words[start - 1] not in (";", "&&", "||", "&", "|", "{"):
+        start -= 1
+    lastCommand = words[start:]
+    while len(lastCommand) > 1 and ASSIGNMENT_PATTERN.match(lastCommand[0]):
+        lastCommand.pop(0)  # variables set for this command only
+    word = lastCommand[0] if lastCommand else ""
+    if (
+        word.lower() in SHELL_STATE_WORDS
+        or ASSIGNMENT_PATTERN.match(word)
+        or word.lower().startswith("$env:")
+    ):
+        return word
+    return None
+
+
+def getDirectArguments(command: str):
+    """
+    Splits command into the program it runs and its arguments, if
+    it's simple enough to run without a shell: just a program on
+    PATH and some words, maybe quoted. Returns None if it isn't.
+    """
+    if not SHELL_METACHARACTERS.isdisjoint(command):
+        return None
+
+    import shlex
+
+    try:
+        arguments = shlex.split(command)
+    except ValueError:
+        return None  # an unclosed quote, which the shell can complain about
+    if not arguments:
+        return None
+    program = arguments[0]
+    if program in SHELL_WORDS or "=" in program or "/" in program:
+        return None  # variable assignments and paths are left to the shell too
+    if any(argument.startswith("=") for argument in arguments):
+        return None  # zsh expands these into paths
+
+    executable = findExecutable(program)
+    if executable is None:
+        return None
+    return executable, arguments
+
+
 def getShell():
+    """
+    Returns the shell to run commands in. YAY_SHELL wins if
+    it's set; otherwise detection results are cached on disk.
+    """
+    if "YAY_SHELL" in os.environ:
+        try:
+            return parseShellSpecification(os.environ["YAY_SHELL"])
+        except ValueError as error:
+            raise ValueError(f"{error}, and YAY_SHELL asks for it") from None
+
+    cachePath = getCacheDirectory() / SHELL_CACHE_FILE
+    cacheKey = getShellCacheKey()
+    try:
+        cachedShells = json.loads(cachePath.read_text())
+        shellTypeName, shellPath = cachedShells[cacheKey]
+        if os.path.exists(shellPath):
+            return ShellInfo(shellPath, ShellType[shellTypeName])
+    except Exception:
+        cachedShells = {}
+
+    shell = detectShell()
+
+    cachedShells.pop(cacheKey, None)
+    cachedShells[cacheKey] = [shell.type.name, shell.path]
+    while len(cachedShells) > SHELL_CACHE_MAX_ENTRIES:
+        del cachedShells[next(iter(cachedShells))]
+    try:
+        cachePath.parent.mkdir(parents=True, exist_ok=True)
+        cachePath.write_text(json.dumps(cachedShells))
+    except OSError:
+        pass
+
+    return shell
+
+
+def detectShell():
+    import shellingham  # walks the process tree, so it's only loaded when needed
+
     shellPath: str
     shellType: ShellType
 
@@ -63,18 +243,24 @@ class MultiShellCommand:
         self._genericPosix = genericPosix
         self._windowsCommandPrompt = windowsCommandPrompt
 
+        self.byShellType: dict[ShellType, object] = {
+            ShellType.PowerShell: powerShell,
+            ShellType.Bash: bash,
+            ShellType.ZShell: zShell,
+            ShellType.GenericPOSIX: genericPosix,
+            ShellType.WindowsCommandPrompt: windowsCommandPrompt,
+        }
+
     def getForShellType(self, shellType: ShellType):
-        match shellType:
-            case ShellType.PowerShell:
-                return self._powerShell
-            case ShellType.Bash:
-                return self._bash
-            case ShellType.ZShell:
-                return self._zShell
-            case ShellType.GenericPOSIX:
-                return self._genericPosix
-            case ShellType.WindowsCommandPrompt:
-                return self._windowsCommandPrompt
+        return self.byShellType.get(shellType)
+
+
+class CommandFailure(Exception):
+    def __init__(self, command: str, returnCode: int, output: str = ""):
+        super().__init__(f"{command!r} exited with code {returnCode}")
+        self.command: str = command
+        self.returnCode: int = returnCode
+        self.output: str = output
 
 
 def getCommandSeparatorForShellType(shellType: ShellType):
@@ -94,36 +280,95 @@ class ComputerProcess:
     # yeah this should be called ShellProcess
     # but isn't "Computer" more whimsical?
 
-    def __init__(self):
-        self.shell: ShellInfo = getShell()
+    keepsState = False  # every run gets a fresh process
+
+    def __init__(
+        self, output: OutputSink | None = None, shell: ShellInfo | None = None
+    ):
+        self.shell: ShellInfo = shell or getShell()
         self.stashedCommands: list[str] = []
+        self.output: OutputSink = output or OutputSink()
 
-    def run(self, command: str):
-        """
-        Runs a command in a new process.
-        """
+    def getArguments(self, command: str):
+        match self.shell.type:
+            case ShellType.PowerShell:
+                return [self.shell.path, "-Command", command]
+            case ShellType.WindowsCommandPrompt:
+                return [self.shell.path, "/c", command]
+            case ShellType.Bash | ShellType.ZShell | ShellType.GenericPOSIX | _:
+                return [self.shell.path, "-c", command]
 
+    def getScriptArguments(self, path: str):
         match self.shell.type:
             case ShellType.PowerShell:
-                output = subprocess.run(
-                    [self.shell.path, "-Command", command],
-                    text=True,
-                    capture_output=True,
-                )
-                print(output.stdout)
+                return [
+                    self.shell.path,
+                    "-NoProfile",
+                    "-ExecutionPolicy",
+                    "Bypass",
+                    "-File",
+                    path,
+                ]
             case ShellType.WindowsCommandPrompt:
-                output = subprocess.run(
-                    [self.shell.path, "/c", command], text=True, capture_output=True
-                )
-                print(output.stdout)
+                return [self.shell.path, "/d", "/c", path]
             case ShellType.Bash | ShellType.ZShell | ShellType.GenericPOSIX | _:
-                output = subprocess.run(
-                    [self.shell.path, "-c", command], text=True, capture_output=True
-                )
-                print(output.stdout)
+                return [self.shell.path, path]
+
+    def getProcessArguments(self, command: str):
+        """
+        Returns the program to start for command (None for the first
+        argument) and its arguments. Simple commands start their
+        program directly, without a shell in between.
+        """
+        if self.shell.type in DIRECT_SHELL_TYPES:
+            directArguments = getDirectArguments(command)
+            if directArguments is not None:
+                return directArguments
+        return None, self.getArguments(command)
+
+    def run(self, command: str, cwd: str | None = None):
+        """
+        Runs a command in a new process, streaming its output
+        as it arrives.
+        """
+        executable, arguments = self.getProcessArguments(command)
+        self.runArguments(arguments, command, cwd, executable)
+
+    def runScript(self, path: str, cwd: str | None = None):
+        """
+        Runs a script file in a new process, streaming its output
+        as it arrives.
+        """
+        self.runArguments(self.getScriptArguments(path), path, cwd)
+
+    def runArguments(
+        self,
+        arguments: list[str],
+        command: str,
+        cwd: str | None,
+        executable: str | None = None,
+    ):
+        try:
+            process = subprocess.Popen(
+                arguments,
+                executable=executable,
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            if executable is None:
+                raise
+            # the program went away since it was looked up
+            return self.runArguments(self.getArguments(command), command, cwd)
+        self.output.clearTail()
+        self.output.follow(process.stdout, process.stderr)
+        returnCode = process.wait()
+        if returnCode < 0 and executable is not None:
+            returnCode = 128 - returnCode  # how a shell reports a signal
 
-        if output.returncode != 0:
-            raise Exception("Error: ", output)
+        if returnCode != 0:
+            raise CommandFailure(command, returnCode, self.output.getTail())
 
     def stashCommand(self, command: str):
         """
@@ -142,9 +387,148 @@ class ComputerProcess:
         Runs all commands in self.stashedCommands, all in
         one "line".
         """
+        self.runBatch(self.stashedCommands)
+
+    def runBatch(self, commands: list[str], cwd: str | None = None):
+        """
+        Runs a batch of commands together, all in one "line".
+        """
+        separator = f"{getCommandSeparatorForShellType(self.shell.type)} "
+        self.run(separator.join(commands), cwd)
+
+
+class ShellSession(ComputerProcess):
+    """
+    A ComputerProcess that keeps one shell running and feeds
+    it commands through stdin, so state like the working
+    directory carries over from one command to the next.
+    """
+
+    keepsState = True
+
+    def __init__(
+        self, output: OutputSink | None = None, shell: ShellInfo | None = None
+    ):
+        super().__init__(output, shell)
+
+        import uuid
+
+        self.sentinel: str = f"__yay_{uuid.uuid4().hex}__"
+        self.process: subprocess.Popen | None = None
+
+    def start(self):
+        match self.shell.type:
+            case ShellType.PowerShell:
+                arguments = [self.shell.path, "-NoProfile", "-NonInteractive"]
+                arguments += ["-Command", "-"]
+            case ShellType.WindowsCommandPrompt:
+                # echo off also hides the prompt
+                arguments = [self.shell.path, "/D", "/Q", "/K"]
+            case ShellType.Bash | ShellType.ZShell | ShellType.GenericPOSIX | _:
+                arguments = [self.shell.path]
 
-        longCommand = f"{getCommandSeparatorForShellType(self.shell.type)} ".join(
-            self.stashedCommands
+        self.process = subprocess.Popen(
+            arguments,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
         )
 
-        self.run(longCommand)
+    def wrapCommand(self, command: str):
+        """
+        Returns command followed by a line that prints the
+        sentinel and the command's exit code. The command is
+        quoted whole where the shell allows it, so one that doesn't
+        parse, like an unclosed string, fails instead of leaving the
+        shell waiting for the rest of it.
+        """
+        match self.shell.type:
+            case ShellType.PowerShell:
+                import base64
+
+                encoded = base64.b64encode(command.encode()).decode()
+                return (
+                    "Invoke-Expression ([Text.Encoding]::UTF8.GetString("
+                    f"[Convert]::FromBase64String('{encoded}')))\n"
+                    f"if ($?) {{ $yayCode = 0 }} "
+                    f"elseif ($LASTEXITCODE) {{ $yayCode = $LASTEXITCODE }} "
+                    f"else {{ $yayCode = 1 }}; "
+                    f'Write-Output "`n{self.sentinel} $yayCode"\n'
+                )
+            case ShellType.WindowsCommandPrompt:
+                return f"{command}\necho.\necho {self.sentinel} %ERRORLEVEL%\n"
+            case ShellType.Bash | ShellType.ZShell | ShellType.GenericPOSIX | _:
+                # commands get their own stdin so they can't eat ours
+                return (
+                    f"eval \"$(cat <<'{self.sentinel}'\n"
+                    f'{command}\n{self.sentinel}\n)" < /dev/null\n'
+                    f"printf '\\n%s %d\\n' '{self.sentinel}' \"$?\"\n"
+                )
+
+    def run(self, command: str, cwd: str | None = None):
+        """
+        Runs a command in the session's shell. The session keeps
+        track of its own working directory, so cwd is ignored.
+        """
+        if self.process is None:
+            self.start()
+
+        self.process.stdin.write(self.wrapCommand(command).encode())
+        self.process.stdin.flush()
+        self.output.clearTail()
+
+        # output is passed along as it arrives, except for
+        # whatever could be the start of the sentinel
+        marker = f"\n{self.sentinel}".encode()
+        buffer = bytearray()
+        while True:
+            chunk = self.process.stdout.read1(CHUNK_SIZE)
+            if not chunk:
+                # the command ended the shell, with exit or otherwise
+                self.output.write(bytes(buffer))
+                returnCode = self.process.wait()
+                self.process = None
+                if returnCode < 0:
+                    returnCode = 128 - returnCode  # how a shell reports a signal
+                if returnCode != 0:
+                    raise CommandFailure(command, returnCode, self.output.getTail())
+                return
+            buffer += chunk
+
+            markerPosition = buffer.find(marker)
+            if markerPosition == -1:
+                flushablePosition = len(buffer) - len(marker) + 1
+                if flushablePosition > 0:
+                    self.output.write(bytes(buffer[:flushablePosition]))
+                    del buffer[:flushablePosition]
+                continue
+
+            lineEnd = buffer.find(b"\n", markerPosition + len(marker))
+            if lineEnd != -1:
+                break
+
+        output = bytes(buffer[:markerPosition])
+        if output.endswith(b"\r"):
+            output = output[:-1]
+        self.output.write(output)
+
+        returnCode = int(buffer[markerPosition + len(marker) : lineEnd].strip() or 1)
+        if returnCode != 0:
+            raise CommandFailure(command, returnCode, self.output.getTail())
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"exit\n")
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sys
+
+from commands import LoweringError
+from computer import ShellInfo, ShellType, getShell
+from misc import getCacheDirectory
+
+FACTS_CACHE_FILE = "facts.json"
+FACTS_CACHE_MAX_ENTRIES = 16
+TOOL_PREFIX = "tools."
+HOST_FACTS = {"osType", "architecture"}  # besides tools.<name>
+
+SHELLTYPE_FACT_MAP = {
+    ShellType.PowerShell: "powershell",
+    ShellType.Bash: "bash",
+    ShellType.ZShell: "zsh",
+    ShellType.GenericPOSIX: "sh",
+    ShellType.WindowsCommandPrompt: "cmd",
+}
+OS_TYPE_MAP = {"darwin": "macos"}
+ARCHITECTURE_MAP = {"amd64": "x86_64", "x64": "x86_64", "aarch64": "arm64"}
+
+
+def getOSType():
+    import platform
+
+    osType = platform.system().lower()
+    return OS_TYPE_MAP.get(osType, osType)
+
+
+def getArchitecture():
+    import platform
+
+    architecture = platform.machine().lower()
+    return ARCHITECTURE_MAP.get(architecture, architecture)
+
+
+def getFactsCacheKey():
+    """
+    Returns what cached facts are kept under. Tools come and go
+    with PATH, and installing one changes its folder's mtime.
+    """
+    parts = [sys.platform]
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        try:
+            parts.append(f"{directory}:{os.stat(directory).st_mtime_ns}")
+        except OSError:
+            parts.append(directory)
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:32]
+
+
+class Facts:
+    """
+    Facts about the host a script runs on, which "?" blocks can
+    check as meta values: meta.osType, meta.architecture,
+    meta.shellType, and meta.tools.<name> for whether a tool is
+    installed ("true" or "false").
+
+    Each fact is only worked out the first time it's asked for.
+    With cache, facts are also kept between runs.
+    """
+
+    def __init__(self, shell: ShellInfo | None = None, cache: bool = False):
+        self.shell: ShellInfo | None = shell
+        self.values: dict[str, str] = {}  # every fact asked for so far
+        self.cache: bool = cache
+        self.cachedValues: dict[str, str] | None = None
+        self.changed: bool = False
+
+    def get(self, name: str):
+        """
+        Returns the fact called name, or None if there's no such fact.
+        """
+        value = self.values.get(name)
+        if value is None:
+            value = self.getCached(name)
+            if value is None:
+                value = self.compute(name)
+                if value is None:
+                    return None
+                self.setCached(name, value)
+            self.values[name] = value
+        return value
+
+    def compute(self, name: str):
+        if name == "osType":
+            return getOSType()
+        if name == "architecture":
+            return getArchitecture()
+        if name == "shellType":
+            self.shell = self.shell or getShell()
+            return SHELLTYPE_FACT_MAP[self.shell.type]
+        if name.startswith(TOOL_PREFIX):
+            import shutil
+
+            tool = name[len(TOOL_PREFIX) :]
+            return "true" if tool and shutil.which(tool) else "false"
+        return None
+
+    def getCached(self, name: str):
+        if not self.cache or name == "shellType":
+            return None
+        if self.cachedValues is None:
+            self.cachedValues = self.readCache().get(getFactsCacheKey(), {})
+        return self.cachedValues.get(name)
+
+    def setCached(self, name: str, value: str):
+        if self.cachedValues is not None and name != "shellType":
+            self.cachedValues[name] = value
+            self.changed = True
+
+    def readCache(self):
+        try:
+            return json.loads((getCacheDirectory() / FACTS_CACHE_FILE).read_text())
+        except Exception:
+            return {}
+
+    def save(self):
+        """
+        Writes the facts worked out in this run into the cache.
+        """
+        if not self.changed:
+            return
+        cachePath = getCacheDirectory() / FACTS_CACHE_FILE
+        cachedFacts = self.readCache()
+        cacheKey = getFactsCacheKey()
+        cachedFacts.pop(cacheKey, None)
+        cachedFacts[cacheKey] = self.cachedValues
+        while len(cachedFacts) > FACTS_CACHE_MAX_ENTRIES:
+            del cachedFacts[next(iter(cachedFacts))]
+        try:
+            cachePath.parent.mkdir(parents=True, exist_ok=True)
+            cachePath.write_text(json.dumps(cachedFacts))
+        except OSError:
+            pass
+        self.changed = False
+
+
+class TargetFacts(Facts):
+    """
+    Facts for a script compiled to run somewhere else, which only
+    knows the shell it's compiled for. Asking for any other fact
+    fails, instead of deciding a "?" block with this host's.
+    """
+
+    def get(self, name: str):
+        if name == "shellType":
+            return super().get(name)
+        if name in HOST_FACTS or name.startswith(TOOL_PREFIX):
+            raise LoweringError(
+                f"meta.{name} is about the computer the script runs on, "
+                "so it can't be decided ahead of time with --output"
+            )
+        return None
@@ -0,0 +1,133 @@
+import hashlib
+import marshal
+import os
+from enum import Enum, auto
+from pathlib import Path
+
+from caching import encodeInstruction
+from misc import TRAMPOLINE_VERSION, getCacheDirectory
+from parsing import Instruction
+
+JOURNAL_DIRECTORY = "journals"
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_HEADER = f"yay journal v{TRAMPOLINE_VERSION}"
+JOURNAL_FINISHED = "finished"
+
+
+class JournalMode(Enum):
+    Record = auto()  # only write down what ran
+    Resume = auto()  # skip what an unfinished run already did
+    Incremental = auto()  # skip whatever is unchanged since the last run
+
+
+def getInstructionHash(instruction: Instruction):
+    # the line is left out, so moving a step around doesn't change it
+    return hashlib.sha256(marshal.dumps(encodeInstruction(instruction)[:4])).digest()
+
+
+class StepJournal:
+    """
+    Writes down every step of a script as it completes, so a
+    later run can skip the steps that already succeeded.
+
+    Each step is keyed by its position, its content and the keys
+    of every step before it, so changing a step also changes the
+    keys of all the steps after it.
+    """
+
+    def __init__(
+        self,
+        scriptPath: str,
+        seed: str = "",
+        mode: JournalMode = JournalMode.Record,
+        directory: Path | None = None,
+    ):
+        directory = directory or getCacheDirectory() / JOURNAL_DIRECTORY
+        pathHash = hashlib.sha256(os.path.abspath(scriptPath).encode()).hexdigest()
+        self.path: Path = directory / f"{pathHash[:32]}{JOURNAL_SUFFIX}"
+        self.mode: JournalMode = mode
+
+        self.lastKey: bytes = hashlib.sha256(seed.encode()).digest()
+        self.position: int = 0
+        self.skippableKeys: list[str] = []
+        self.skippedSteps: int = 0
+        self.journalFile = None
+
+    def open(self):
+        """
+        Reads what the last run did, and starts writing down
+        this one.
+        """
+        previousKeys, finished = self.read()
+        if self.mode is JournalMode.Incremental or (
+            self.mode is JournalMode.Resume and not finished
+        ):
+            self.skippableKeys = previousKeys
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.journalFile = open(self.path, "w")
+            self.journalFile.write(JOURNAL_HEADER + "\n")
+            self.journalFile.flush()
+        except OSError:
+            self.journalFile = None  # run without a journal
+        return self
+
+    def read(self):
+        try:
+            lines = self.path.read_text().splitlines()
+        except OSError:
+            return [], False
+        if not lines or lines[0] != JOURNAL_HEADER:
+            return [], False
+        finished = lines[-1] == JOURNAL_FINISHED
+        return [line for line in lines[1:] if line != JOURNAL_FINISHED], finished
+
+    def getStepKey(self, instruction: Instruction):
+        """
+        Returns the key of the next step, which is instruction.
+        """
+        digest = hashlib.sha256(self.lastKey)
+        digest.update(self.position.to_bytes(8, "little"))
+        digest.update(getInstructionHash(instruction))
+        self.lastKey = digest.digest()
+        self.position += 1
+        return self.lastKey.hex()[:32]
+
+    def hasCompleted(self, stepKey: str):
+        """
+        Returns whether the step with stepKey can be skipped. Call
+        it right after getStepKey.
+        """
+        position = self.position - 1
+        return (
+            position < len(self.skippableKeys)
+            and self.skippableKeys[position] == stepKey
+        )
+
+    def recordStep(self, stepKey: str):
+        self.write(stepKey)
+
+    def finish(self):
+        self.write(JOURNAL_FINISHED)
+
+    def write(self, line: str):
+        if self.journalFile is None:
+            return
+        try:
+            self.journalFile.write(line + "\n")
+            self.journalFile.flush()
+        except OSError:
+            pass
+
+    def close(self):
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *_):
+        self.close()
+        return False
@@ -1,45 +1,829 @@
-import typer
-from tokenization import Tokenizer
-from parsing import Parser
-from running import runInstructions
-
-from rich import print
+import os
+import sys
 from pathlib import Path
 
-app = typer.Typer(add_completion = False)
+from misc import TRAMPOLINE_VERSION
+
+# typer and rich are only imported when they're actually needed:
+# the common "run a file" path skips them entirely (see fastMain)
+
+RUN_FLAGS = {
+    "--stream": "stream",
+    "--session": "session",
+    "--no-cache": "noCache",
+    "--compiled": "compiled",
+    "--resume": "resume",
+    "--incremental": "incremental",
+    "--no-server": "noServer",
+}
+RUN_OPTIONS = {
+    "--log": "log",
+    "--jobs": "jobs",
+    "-j": "jobs",
+    "--shell": "shell",
+    "--profile": "profile",
+    "--profile-format": "profileFormat",
+}
+RUN_OPTION_TYPES = {"jobs": int}
+
+
+def say(message: str):
+    """
+    Prints a message with rich markup, loading rich only when
+    there's a terminal to color.
+    """
+    if sys.stdout.isatty():
+        from rich import print as richPrint
+
+        richPrint(message)
+    else:
+        from misc import stripMarkup
+
+        print(stripMarkup(message))
+
+
+class RunFailure(Exception):
+    pass
+
+
+def expandScriptPaths(paths: list[str]):
+    """
+    Expands directories (into the .yay files inside them) and
+    glob patterns, for shells that don't expand them by themselves.
+    """
+    import glob
+
+    scriptPaths: list[str] = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                raise RunFailure(f"/ hmm. nothing matches {path}.")
+        elif Path(path).is_dir():
+            matches = sorted(
+                glob.glob(str(Path(path) / "*.yay"))
+                + glob.glob(str(Path(path) / "*.yay.gz"))
+            )
+            if not matches:
+                raise RunFailure(f"/ hmm. there aren't any .yay files in {path}.")
+        else:
+            matches = [path]
+        scriptPaths += [match for match in matches if match not in scriptPaths]
+    return scriptPaths
+
 
-@app.callback(invoke_without_command=True)
-def main(ctx: typer.Context):
-    if ctx.invoked_subcommand is not None:
-        return
-    print("[bold yellow]🤸 yay trampoline v0.1[/bold yellow]")
-    print("/ try --help!")
+def isBatch(paths: list[str]):
+    import glob
 
-@app.command()
-def run(
-    file: str = typer.Argument("A .yay file to run")
+    return len(paths) > 1 or any(
+        glob.has_magic(path) or Path(path).is_dir() for path in paths
+    )
+
+
+def runFiles(files: list[str], jobs: int = 1, **options):
+    """
+    Runs one script, or a batch of them. In a batch, --jobs is
+    how many scripts run at once instead of how many steps.
+    """
+    if not isBatch(files):
+        return runFile(files[0], jobs=jobs, **options)
+    return runBatch(expandScriptPaths(files), jobs, **options)
+
+
+def runBatch(
+    files: list[str],
+    jobs: int = 1,
+    stream: bool = False,
+    session: bool = False,
+    noCache: bool = False,
+    log: str | None = None,
+    shell: str | None = None,
+    profile: str | None = None,
+    profileFormat: str = "report",
+    compiled: bool = False,
+    resume: bool = False,
+    incremental: bool = False,
+    shellInfo=None,
 ):
+    """
+    Runs every script in files on a pool of jobs workers, which
+    share one shell detection and one output. Prints a summary,
+    and fails if any script failed.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    from output import OutputSink, PrefixedOutputSink
+
+    if profile:
+        raise RunFailure("/ hmm. --profile only works with a single script.")
+
+    shellInfo = shellInfo or getShellInfo(shell) or getDefaultShell()
+    output = OutputSink(log)
+
+    def runBatchFile(file: str):
+        fileOutput = PrefixedOutputSink(output, f"[{file}] ")
+        start = time.perf_counter()
+        error = None
+        try:
+            runFile(
+                file,
+                stream=stream,
+                session=session,
+                noCache=noCache,
+                compiled=compiled,
+                resume=resume,
+                incremental=incremental,
+                shellInfo=shellInfo,
+                output=fileOutput,
+            )
+        except RunFailure as failure:
+            error = str(failure)
+        except Exception as exception:
+            error = f"/ yikes! {exception}"
+        finally:
+            fileOutput.close()
+        return file, error, time.perf_counter() - start
+
+    say(f"[blue]/ running {len(files)} scripts, {jobs} at a time...[/blue]")
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            results = list(pool.map(runBatchFile, files))
+    finally:
+        output.close()
+    duration = time.perf_counter() - start
+
+    failures = [result for result in results if result[1] is not None]
+    say(
+        f"\n/ ran {len(results)} scripts in {duration:.2f}s: "
+        f"[green]{len(results) - len(failures)} ok[/green], "
+        f"[red]{len(failures)} failed[/red]"
+    )
+    for file, error, fileDuration in results:
+        if error is None:
+            say(f"- [green]ok[/green]     {file} ({fileDuration:.2f}s)")
+        else:
+            say(f"- [red]failed[/red] {file} ({fileDuration:.2f}s)")
+            say(f"  {error}")
+
+    if failures:
+        raise RunFailure(f"/ oh no! {len(failures)} of {len(results)} scripts failed.")
+
+
+def getScriptFile(file: str):
+    """
+    Checks that file is a yay script (or "-", for stdin), and
+    returns its path.
+    """
+    if file == "-":
+        return None
     workingFile = Path(file).resolve()
     if not workingFile.exists():
-        print("/ hmm. it seems that file doesn't exist.")
-        raise typer.Exit(code=1)
+        raise RunFailure("/ hmm. it seems that file doesn't exist.")
     if not workingFile.is_file():
-        print("/ hold on! are you sure that's a file?")
-        raise typer.Exit(code=1)
-    if not workingFile.suffix == ".yay":
-        print("/ aah! that doesn't seem to be a valid yay script file.")
+        raise RunFailure("/ hold on! are you sure that's a file?")
+    if not (workingFile.suffix == ".yay" or workingFile.name.endswith(".yay.gz")):
         if workingFile.suffix == ".xml":
-            print("/ ...XML??? ew???")
-        raise typer.Exit(code=1)
-    
-    yayfile = open(file, "tr")
-    yaytext = yayfile.read()
+            raise RunFailure(
+                "/ aah! that doesn't seem to be a valid yay script file.\n"
+                "/ ...XML??? ew???"
+            )
+        raise RunFailure("/ aah! that doesn't seem to be a valid yay script file.")
+    return workingFile
+
+
+def getShellInfo(shell: str | None, requirePath: bool = True):
+    from computer import parseShellSpecification
+
+    if shell is None:
+        return None
+    try:
+        return parseShellSpecification(shell, requirePath)
+    except ValueError as error:
+        raise RunFailure(f"/ hmm. {error}.")
+
+
+def getDefaultShell():
+    """
+    Returns the shell getShell picks, failing nicely when
+    YAY_SHELL names one the trampoline doesn't know.
+    """
+    from computer import getShell
+
+    try:
+        return getShell()
+    except ValueError as error:
+        raise RunFailure(f"/ hmm. {error}.")
+
+
+def loadInstructions(
+    source,
+    scriptHash: str | None,
+    noCache: bool,
+    profiler,
+    facts=None,
+    keepBlocks: bool = False,
+):
+    """
+    Returns the script's instructions, from the instruction cache
+    if they're there, or tokenized and parsed as they're needed.
+    Scripts without a hash (like ones read from stdin) aren't cached.
+
+    They're resolved against facts about the host after the cache,
+    since those can change from run to run. With keepBlocks, the
+    blocks that run are kept as blocks.
+    """
+    from caching import InstructionCache
+    from parsing import Parser
+    from resolving import resolveInstructions
+    from tokenization import iterTokensFromChunks
+
+    noCache = noCache or scriptHash is None
+
+    instructions = None
+    if not noCache:
+        with profiler.measure("load cache"):
+            cache = InstructionCache()
+            instructions = cache.load(scriptHash)
+
+    if instructions is None:
+        tokens = profiler.measureIterable(
+            "tokenize", iterTokensFromChunks(source.iterChunks())
+        )
+        instructions = profiler.measureIterable(
+            "parse", Parser(tokens).iterInstructions()
+        )
+        if not noCache:
+            instructions = cache.cacheInstructions(scriptHash, instructions)
+    return profiler.measureIterable(
+        "resolve", resolveInstructions(instructions, facts=facts, keepBlocks=keepBlocks)
+    )
+
+
+def runFile(
+    file: str,
+    stream: bool = False,
+    session: bool = False,
+    noCache: bool = False,
+    log: str | None = None,
+    jobs: int = 1,
+    shell: str | None = None,
+    profile: str | None = None,
+    profileFormat: str = "report",
+    compiled: bool = False,
+    resume: bool = False,
+    incremental: bool = False,
+    shellInfo=None,
+    output=None,
+):
+    """
+    Runs a single script. Batches pass in the shell they've
+    already detected, and the output sink to write to.
+    """
+    from commands import LoweringError
+    from computer import CommandFailure
+    from facts import Facts
+    from journaling import JournalMode, StepJournal
+    from profiling import NULL_PROFILER, Profiler
+    from running import runInstructions
+    from sources import openScriptSource
+
+    profiler = Profiler() if profile else NULL_PROFILER
+
+    workingFile = getScriptFile(file)
+    shellInfo = shellInfo or getShellInfo(shell)
+    if compiled and (stream or session or jobs > 1):
+        raise RunFailure(
+            "/ hmm. --compiled runs the whole script at once, so it "
+            "can't be combined with --stream, --session or --jobs."
+        )
+    if (resume or incremental) and (compiled or jobs > 1):
+        raise RunFailure(
+            "/ hmm. --resume and --incremental go step by step, so they "
+            "can't be combined with --compiled or --jobs."
+        )
+    if (resume or incremental) and session:
+        # a skipped step could be the "$ cd" or "$ export" the rest rely on
+        raise RunFailure(
+            "/ hmm. --resume and --incremental can't skip steps in a --session, "
+            "since the steps after them depend on what they did to the shell."
+        )
+    if resume and incremental:
+        raise RunFailure("/ hmm. pick one of --resume and --incremental.")
+    if (resume or incremental) and workingFile is None:
+        raise RunFailure("/ hmm. --resume and --incremental need a file, not stdin.")
+
+    with profiler.measure("read"):
+        source = openScriptSource(file)
+        scriptHash = source.getHash()
+    facts = Facts(shellInfo, cache=not noCache)
+
+    try:
+        if compiled:
+            runCompiledFile(
+                source, scriptHash, noCache, log, shellInfo, profiler, output, facts
+            )
+            return
+
+        # runs that don't go step by step go a block at a time
+        batched = not (stream or session or resume or incremental or jobs > 1)
+        instructions = loadInstructions(
+            source, scriptHash, noCache, profiler, facts, keepBlocks=batched
+        )
+
+        with profiler.measure("detect shell"):
+            shellInfo = shellInfo or getDefaultShell()
+        facts.shell = shellInfo  # instructions are resolved as they run
+
+        # step by step runs keep a journal, which --resume and
+        # --incremental use to skip what's already done
+        journal = None
+        if workingFile is not None and (stream or session or resume or incremental):
+            journalMode = JournalMode.Record
+            if resume:
+                journalMode = JournalMode.Resume
+            elif incremental:
+                journalMode = JournalMode.Incremental
+            journal = StepJournal(
+                str(workingFile),
+                seed=f"{shellInfo.type.name}\0{os.getcwd()}",
+                mode=journalMode,
+            ).open()
+
+        if output is None:
+            say("[blue]/ reading instructions...[/blue]")
+        try:
+            runInstructions(
+                instructions,
+                streaming=stream or journal is not None,
+                session=session,
+                logPath=log,
+                jobs=jobs,
+                shell=shellInfo,
+                profiler=profiler,
+                output=output,
+                journal=journal,
+            )
+        finally:
+            if journal is not None:
+                journal.close()
+    except CommandFailure as failure:
+        raise RunFailure(
+            f"/ oh no! [red]{failure.command}[/red] failed "
+            f"with exit code {failure.returnCode}."
+        )
+    except LoweringError as error:
+        raise RunFailure(f"/ hmm. {error}.")
+    except UnicodeDecodeError:
+        raise RunFailure("/ aah! that script isn't valid UTF-8 text.")
+    finally:
+        source.close()
+        facts.save()
+        if profile:
+            profiler.write(profile, profileFormat)
+
+
+def runCompiledFile(
+    source, scriptHash, noCache, log, shellInfo, profiler, output=None, facts=None
+):
+    """
+    Runs a script through its compiled shell script, compiling
+    it first if it isn't in the cache.
+    """
+    import tempfile
+
+    from compiling import ScriptCache, compileInstructions, writeScript
+    from facts import Facts
+    from running import runScriptFile
+
+    with profiler.measure("detect shell"):
+        shellInfo = shellInfo or getDefaultShell()
+    facts = facts or Facts(shellInfo)
+    facts.shell = shellInfo
+
+    noCache = noCache or scriptHash is None
+    scriptCache = ScriptCache()
+    path = None
+    if not noCache:
+        with profiler.measure("load compiled"):
+            path = scriptCache.load(scriptHash, shellInfo.type, facts)
+
+    temporaryDirectory = None
+    if path is None:
+        instructions = loadInstructions(source, scriptHash, noCache, profiler, facts)
+        with profiler.measure("compile"):
+            text = compileInstructions(
+                instructions, shellInfo.type, scriptHash or "stdin"
+            )
+        if not noCache:
+            path = scriptCache.store(scriptHash, shellInfo.type, text, facts.values)
+        if path is None:
+            temporaryDirectory = tempfile.TemporaryDirectory()
+            path = (
+                Path(temporaryDirectory.name)
+                / scriptCache.getPath(scriptHash or "stdin", shellInfo.type).name
+            )
+            writeScript(path, text, shellInfo.type)
+
+    if output is None:
+        say("[blue]/ running compiled script...[/blue]")
+    try:
+        runScriptFile(
+            str(path), logPath=log, shell=shellInfo, profiler=profiler, output=output
+        )
+    finally:
+        if temporaryDirectory is not None:
+            temporaryDirectory.cleanup()
+
+
+def compileFile(
+    file: str,
+    output: str | None = None,
+    shell: str | None = None,
+    noCache: bool = False,
+):
+    """
+    Compiles a script into a shell script, and returns where
+    it was written. A script written to output may run on another
+    computer, so its "?" blocks can only check meta.shellType.
+    """
+    from commands import LoweringError
+    from compiling import ScriptCache, compileInstructions, writeScript
+    from facts import Facts, TargetFacts
+    from profiling import NULL_PROFILER
+    from sources import openScriptSource
+
+    getScriptFile(file)
+    # a script written elsewhere may be for a shell this computer doesn't have,
+    # and its "?" blocks can't be decided with this computer's facts
+    shellInfo = getShellInfo(shell, requirePath=output is None) or getDefaultShell()
+    if output is None:
+        facts = Facts(shellInfo, cache=not noCache)
+    else:
+        facts = TargetFacts(shellInfo)
+
+    with openScriptSource(file) as source:
+        scriptHash = source.getHash()
+        noCache = noCache or scriptHash is None
+        scriptCache = ScriptCache()
+
+        if output is None and not noCache:
+            path = scriptCache.load(scriptHash, shellInfo.type, facts)
+            if path is not None:
+                return path
+
+        instructions = loadInstructions(
+            source, scriptHash, noCache, NULL_PROFILER, facts
+        )
+        try:
+            text = compileInstructions(
+                instructions, shellInfo.type, scriptHash or "stdin"
+            )
+        except LoweringError as error:
+            raise RunFailure(f"/ hmm. {error}.")
+        except UnicodeDecodeError:
+            raise RunFailure("/ aah! that script isn't valid UTF-8 text.")
+    facts.save()
+
+    if output is not None:
+        try:
+            writeScript(Path(output), text, shellInfo.type)
+        except OSError as error:
+            raise RunFailure(f"/ hmm. couldn't write {output}: {error.strerror}.")
+        return Path(output)
+
+    path = None
+    if not noCache:
+        path = scriptCache.store(scriptHash, shellInfo.type, text, facts.values)
+    if path is None:
+        raise RunFailure(
+            "/ hmm. couldn't write to the cache. try --output to pick a file."
+        )
+    return path
+
+
+def watchFile(
+    file: str, run: bool = False, shell: str | None = None, poll: bool = False
+):
+    """
+    Checks a script every time it's saved, re-reading only the
+    instructions around the lines that changed. With run, it runs
+    the script too.
+    """
+    import time
+
+    from commands import LoweringError
+    from computer import CommandFailure
+    from facts import Facts
+    from resolving import resolveInstructions
+    from running import getCommandForInstruction, runInstructions
+    from watching import IncrementalScript, PollingWatcher, getWatcher
+
+    if getScriptFile(file) is None or file.endswith(".yay.gz"):
+        raise RunFailure("/ hmm. watch only works with plain .yay files.")
+    shellInfo = getShellInfo(shell) or getDefaultShell()
+    script = IncrementalScript()
+    watcher = PollingWatcher(file) if poll else getWatcher(file)
+
+    say(f"[blue]/ watching {file}... (ctrl+c to stop)[/blue]")
+    try:
+        while True:
+            try:
+                text = Path(file).read_text()
+            except OSError as error:
+                say(f"/ hmm. couldn't read {file}: {error.strerror}.")
+                text = None
+
+            start = time.perf_counter()
+            change = None if text is None else script.update(text)
+            if change is not None:
+                milliseconds = (time.perf_counter() - start) * 1000
+                say(
+                    f"[blue]/ re-read {len(change.instructions)} instructions "
+                    f"({change.lineCount} lines) in {milliseconds:.1f}ms[/blue]"
+                )
+                try:
+                    for instruction in change.instructions:
+                        getCommandForInstruction(instruction, shellInfo.type)
+                    if run:
+                        runInstructions(
+                            list(
+                                resolveInstructions(
+                                    script.instructions, facts=Facts(shellInfo)
+                                )
+                            ),
+                            shell=shellInfo,
+                        )
+                    say("[green]/ looks good![/green]")
+                except LoweringError as error:
+                    say(f"/ hmm. {error}.")
+                except CommandFailure as failure:
+                    say(
+                        f"/ oh no! [red]{failure.command}[/red] failed "
+                        f"with exit code {failure.returnCode}."
+                    )
+
+            watcher.wait()
+    except KeyboardInterrupt:
+        say("/ bye!")
+    finally:
+        watcher.close()
+
+
+def parseRunArguments(arguments: list[str]):
+    """
+    Understands the simple "run" invocations without typer.
+    Returns None for anything it doesn't know about.
+    """
+    options = {}
+    remainingArguments = iter(arguments)
+    for argument in remainingArguments:
+        if argument in RUN_FLAGS:
+            options[RUN_FLAGS[argument]] = True
+        elif argument in RUN_OPTIONS:
+            name = RUN_OPTIONS[argument]
+            value = next(remainingArguments, None)
+            if value is None:
+                return None
+            try:
+                options[name] = RUN_OPTION_TYPES.get(name, str)(value)
+            except ValueError:
+                return None
+        elif argument.startswith("-") and argument != "-":
+            return None
+        else:
+            options.setdefault("files", []).append(argument)
+
+    if "files" not in options:
+        return None
+    return options
+
+
+def runRequest(options: dict):
+    """
+    Runs what "run" was asked to, and returns an exit code.
+    """
+    try:
+        runFiles(**options)
+    except RunFailure as failure:
+        say(str(failure))
+        return 1
+    return 0
+
+
+def startRun(options: dict):
+    """
+    Hands a run over to `trampoline serve` if it's running, and
+    runs it here otherwise. Returns an exit code.
+    """
+    if not options.pop("noServer", False):
+        from serving import submitRun
+
+        exitCode = submitRun(options)
+        if exitCode is not None:
+            return exitCode
+    return runRequest(options)
+
+
+def serveRuns(shell: str | None = None):
+    from serving import ServeFailure, serve
+
+    try:
+        serve(runRequest, getShellInfo(shell))
+    except ServeFailure as failure:
+        raise RunFailure(str(failure))
+
+
+def fastMain(arguments: list[str]):
+    """
+    Handles --version and simple runs without loading typer.
+    Returns an exit code, or None to let typer take over.
+    """
+    if arguments == ["--version"]:
+        print(f"yay trampoline v{TRAMPOLINE_VERSION}")
+        return 0
+
+    if arguments[:1] == ["run"]:
+        options = parseRunArguments(arguments[1:])
+        if options is not None:
+            return startRun(options)
+
+    return None
+
+
+def getApp():
+    import typer
+
+    app = typer.Typer(add_completion=False)
+
+    @app.callback(invoke_without_command=True)
+    def welcome(
+        ctx: typer.Context,
+        version: bool = typer.Option(
+            False, "--version", help="Show the trampoline's version"
+        ),
+    ):
+        if version:
+            print(f"yay trampoline v{TRAMPOLINE_VERSION}")
+            raise typer.Exit()
+        if ctx.invoked_subcommand is not None:
+            return
+        say("[bold yellow]🤸 yay trampoline v0.1[/bold yellow]")
+        say("/ try --help!")
+
+    @app.command()
+    def run(
+        files: list[str] = typer.Argument(
+            ...,
+            help="The .yay or .yay.gz files to run, directories or globs of them, or - for stdin",
+        ),
+        stream: bool = typer.Option(
+            False,
+            "--stream",
+            help="Run each instruction as soon as it's read, each in a shell of its own",
+        ),
+        session: bool = typer.Option(
+            False, "--session", help="Run every instruction in one long-lived shell"
+        ),
+        log: str = typer.Option(
+            None, "--log", help="Also write the output of every command to this file"
+        ),
+        jobs: int = typer.Option(
+            1,
+            "--jobs",
+            "-j",
+            help="Run up to this many independent steps (like clones), or scripts in a batch, at once",
+        ),
+        shell: str = typer.Option(
+            None,
+            "--shell",
+            help="Skip shell detection and use this one, like bash or bash:/bin/bash",
+        ),
+        noCache: bool = typer.Option(
+            False, "--no-cache", help="Don't use or update the compiled script cache"
+        ),
+        profile: str = typer.Option(
+            None,
+            "--profile",
+            help="Write per-phase and per-instruction timings to this file",
+        ),
+        profileFormat: str = typer.Option(
+            "report",
+            "--profile-format",
+            help="report (JSON) or trace (Chrome trace events)",
+        ),
+        compiled: bool = typer.Option(
+            False,
+            "--compiled",
+            help="Run the script as a compiled shell script, compiling it if needed",
+        ),
+        resume: bool = typer.Option(
+            False,
+            "--resume",
+            help="Skip the steps an unfinished run already did, up to the first changed one",
+        ),
+        incremental: bool = typer.Option(
+            False,
+            "--incremental",
+            help="Skip every step that's unchanged since the last run, up to the first changed one",
+        ),
+        noServer: bool = typer.Option(
+            False, "--no-server", help="Run here even if trampoline serve is running"
+        ),
+    ):
+        exitCode = startRun(
+            dict(
+                files=files,
+                jobs=jobs,
+                stream=stream,
+                session=session,
+                noCache=noCache,
+                log=log,
+                shell=shell,
+                profile=profile,
+                profileFormat=profileFormat,
+                compiled=compiled,
+                resume=resume,
+                incremental=incremental,
+                noServer=noServer,
+            )
+        )
+        if exitCode != 0:
+            raise typer.Exit(code=exitCode)
+
+    @app.command()
+    def compile(
+        file: str = typer.Argument(
+            ..., help="A .yay or .yay.gz file to compile, or - for stdin"
+        ),
+        output: str = typer.Option(
+            None,
+            "--output",
+            "-o",
+            help="Write the shell script here instead of to the cache. Its ? blocks can only check meta.shellType",
+        ),
+        shell: str = typer.Option(
+            None,
+            "--shell",
+            help="Compile for this shell instead of the detected one, like bash or pwsh",
+        ),
+        noCache: bool = typer.Option(
+            False,
+            "--no-cache",
+            help="Don't use or update the instruction and script caches",
+        ),
+    ):
+        try:
+            print(compileFile(file, output, shell, noCache))
+        except RunFailure as failure:
+            say(str(failure))
+            raise typer.Exit(code=1)
+
+    @app.command()
+    def watch(
+        file: str = typer.Argument(..., help="A .yay file to watch"),
+        run: bool = typer.Option(
+            False,
+            "--run",
+            help="Run the script every time it changes, not just check it",
+        ),
+        shell: str = typer.Option(
+            None,
+            "--shell",
+            help="Skip shell detection and use this one, like bash or bash:/bin/bash",
+        ),
+        poll: bool = typer.Option(
+            False,
+            "--poll",
+            help="Check the file every so often instead of waiting for change notifications",
+        ),
+    ):
+        try:
+            watchFile(file, run, shell, poll)
+        except RunFailure as failure:
+            say(str(failure))
+            raise typer.Exit(code=1)
+
+    @app.command()
+    def serve(
+        shell: str = typer.Option(
+            None,
+            "--shell",
+            help="Use this shell for runs that don't pick one, instead of the detected one",
+        ),
+    ):
+        try:
+            serveRuns(shell)
+        except RunFailure as failure:
+            say(str(failure))
+            raise typer.Exit(code=1)
 
-    tokens = Tokenizer(yaytext).getTokens()
-    instructions = Parser(tokens).getInstructions()
+    return app
 
-    print("[blue]/ reading instructions...[/blue]")
-    runInstructions(instructions)
 
 if __name__ == "__main__":
-    app()
\ No newline at end of file
+    exitCode = fastMain(sys.argv[1:])
+    if exitCode is not None:
+        sys.exit(exitCode)
+    getApp()()
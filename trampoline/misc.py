@@ -1,3 +1,12 @@
+import os
+import re
+from pathlib import Path
+
+TRAMPOLINE_VERSION = "0.1.0"
+
+MARKUP_PATTERN = re.compile(r"\[/?[a-z][a-z ]*\]")
+
+
 def isNumber(string: str):
     numberable: bool = False
     try:
@@ -20,3 +29,62 @@ def isNumber(string: str):
 
 def isWhiteSpace(string: str):
     return string.isspace() or len(string) == 0
+
+
+def getCacheDirectory():
+    """
+    Returns the folder the trampoline keeps its caches in.
+    """
+    if "YAY_CACHE_DIR" in os.environ:
+        return Path(os.environ["YAY_CACHE_DIR"])
+    if os.name == "nt" and "LOCALAPPDATA" in os.environ:
+        return Path(os.environ["LOCALAPPDATA"]) / "trampoline" / "cache"
+    if "XDG_CACHE_HOME" in os.environ:
+        return Path(os.environ["XDG_CACHE_HOME"]) / "trampoline"
+    return Path.home() / ".cache" / "trampoline"
+
+
+def getParentProcessName():
+    """
+    Returns the name of the program that started this one, or ""
+    if there's no cheap way to tell.
+    """
+    try:
+        with open(f"/proc/{os.getppid()}/comm") as commFile:
+            return commFile.read().strip()
+    except OSError:
+        pass
+    if os.name != "posix":
+        return ""  # the parent's process id would only churn the cache
+
+    import subprocess  # for systems without /proc, like macOS
+
+    try:
+        return subprocess.run(
+            ["ps", "-o", "comm=", "-p", str(os.getppid())],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def getShellCacheKey():
+    """
+    Returns what shell detection depends on, which detected
+    shells are cached by.
+    """
+    return "\0".join(
+        [
+            getParentProcessName(),
+            os.environ.get("SHELL", ""),
+            os.environ.get("COMSPEC", ""),
+        ]
+    )
+
+
+def stripMarkup(string: str):
+    """
+    Removes rich markup like [bold red] from a string.
+    """
+    return MARKUP_PATTERN.sub("", string)
@@ -0,0 +1,130 @@
+import sys
+import threading
+from typing import BinaryIO
+
+CHUNK_SIZE = 64 * 1024  # bytes read from a pipe at a time
+TAIL_SIZE = 64 * 1024  # bytes of output kept around for error messages
+
+
+class OutputSink:
+    """
+    Writes process output to the terminal as it arrives, and
+    optionally tees it into a log file.
+    """
+
+    def __init__(self, logPath: str | None = None):
+        self.lock = threading.Lock()
+        self.logFile: BinaryIO | None = open(logPath, "ab") if logPath else None
+        self.tail = bytearray()
+
+    def write(self, data: bytes, isError: bool = False):
+        with self.lock:
+            target = sys.stderr if isError else sys.stdout
+            target.flush()  # don't overtake text that's already buffered
+            if hasattr(target, "buffer"):
+                target.buffer.write(data)
+                target.buffer.flush()
+            else:
+                target.write(data.decode(errors="replace"))
+                target.flush()
+
+            if self.logFile is not None:
+                self.logFile.write(data)
+
+            self.tail += data
+            del self.tail[:-TAIL_SIZE]
+
+    def pump(self, pipe: BinaryIO, isError: bool = False):
+        """
+        Copies pipe into the sink chunk by chunk until it closes.
+        """
+        while chunk := pipe.read1(CHUNK_SIZE):
+            self.write(chunk, isError)
+
+    def follow(self, stdout: BinaryIO, stderr: BinaryIO):
+        """
+        Pumps a process' stdout and stderr at the same time.
+        """
+        errorPump = threading.Thread(target=self.pump, args=(stderr, True))
+        errorPump.start()
+        self.pump(stdout)
+        errorPump.join()
+
+    def clearTail(self):
+        with self.lock:
+            self.tail.clear()
+
+    def getTail(self):
+        return self.tail.decode(errors="replace")
+
+    def close(self):
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+
+
+class PrefixedOutputSink(OutputSink):
+    """
+    An OutputSink that labels every line with a prefix before
+    handing it over to another sink.
+    """
+
+    def __init__(self, parent: OutputSink, prefix: str):
+        super().__init__()
+        self.parent: OutputSink = parent
+        self.prefix: bytes = prefix.encode()
+        self.partialLines: dict[bool, bytearray] = {
+            False: bytearray(),
+            True: bytearray(),
+        }
+
+    def write(self, data: bytes, isError: bool = False):
+        with self.lock:
+            self.tail += data
+            del self.tail[:-TAIL_SIZE]
+
+            partialLine = self.partialLines[isError]
+            partialLine += data
+            lineEnd = partialLine.rfind(b"\n") + 1
+            if lineEnd == 0:
+                if len(partialLine) < CHUNK_SIZE:
+                    return
+                lineEnd = len(partialLine)  # don't let long lines pile up
+            lines = bytes(partialLine[:lineEnd])
+            del partialLine[:lineEnd]
+
+        labelledLines = b"".join(
+            self.prefix + line for line in lines.splitlines(keepends=True)
+        )
+        if not labelledLines.endswith(b"\n"):
+            labelledLines += b"\n"
+        self.parent.write(labelledLines, isError)
+
+    def close(self):
+        for isError, partialLine in self.partialLines.items():
+            if partialLine:
+                self.parent.write(self.prefix + bytes(partialLine) + b"\n", isError)
+                partialLine.clear()
+
+
+class CapturedOutputSink(OutputSink):
+    """
+    An OutputSink that keeps everything written to it, instead
+    of printing it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.captured: dict[bool, bytearray] = {
+            False: bytearray(),
+            True: bytearray(),
+        }
+
+    def write(self, data: bytes, isError: bool = False):
+        with self.lock:
+            self.captured[isError] += data
+            self.tail += data
+            del self.tail[:-TAIL_SIZE]
+
+    def getText(self, isError: bool = False):
+        return self.captured[isError].decode(errors="replace")
@@ -1,8 +1,6 @@
 from enum import Enum, auto
+from typing import Iterable, Union
 
-from typing_extensions import TypedDict, Union
-
-from misc import isNumber
 from tokenization import Token, TokenType
 
 
@@ -17,6 +15,7 @@ class CommandType(Enum):
     RunAction = auto()  # !
     ShellEnter = auto()  # $
     Ignore = auto()  # /
+    Condition = auto()  # ?
 
 
 class ReferenceType(Enum):
@@ -35,8 +34,23 @@ COMMANDTOKENTEXT_COMMANDTYPE_MAP = {
     "!": CommandType.RunAction,
     "$": CommandType.ShellEnter,
     "/": CommandType.Ignore,
+    "?": CommandType.Condition,
 }
 
+# references that start with these are names in the store "%" sets
+STORE_PREFIXES = ("meta.", "global.")
+
+
+def getStoreName(reference: str):
+    """
+    Returns the store name reference is for, or None if it isn't
+    a reference to the store.
+    """
+    for prefix in STORE_PREFIXES:
+        if reference.startswith(prefix):
+            return reference[len(prefix) :]
+    return None
+
 
 class ArgumentType(Enum):
     InstructionSet = auto()
@@ -46,130 +60,222 @@ class ArgumentType(Enum):
 
 
 class Argument:
-    def __init__(self, type: ArgumentType, value: Union[str, int, list]) -> None:
+    __slots__ = ("type", "value", "slot")
+
+    def __init__(
+        self,
+        type: ArgumentType,
+        value: Union[str, int, list],
+        slot: int | None = None,
+    ) -> None:
         self.type: ArgumentType = type
         self.value: Union[str, int, list] = value
+        self.slot: int | None = slot  # the store slot a reference points to
 
 
 class Instruction:
+    __slots__ = (
+        "commandType",
+        "referenceType",
+        "reference",
+        "arguments",
+        "line",
+        "slot",
+    )
+
     def __init__(
         self,
         commandType: CommandType,
         referenceType: ReferenceType | None = None,
         reference: str | None = None,
-        arguments: list[Argument] = [],
+        arguments: list[Argument] | None = None,
+        line: int = 0,
+        slot: int | None = None,
     ):
         self.commandType = commandType
         self.referenceType = referenceType
         self.reference = reference
-        self.arguments = arguments
-
-
-class InstructionConstructionObject(TypedDict):
-    commandType: CommandType | None
-    referenceType: ReferenceType | None
-    referenceValue: str | None
-    arguments: list[Argument]
-    stringArgumentAccumulation: str | None
+        self.arguments = [] if arguments is None else arguments
+        self.line = line  # where the instruction starts in its script
+        self.slot = slot  # the store slot a "%" instruction sets
 
 
 class Parser:
-    def __init__(self, tokens: list[Token]):
-        self.tokens: list[Token] = tokens
+    def __init__(self, tokens: Iterable[Token], slots: dict[str, int] | None = None):
+        self.tokens: Iterable[Token] = tokens
+        # store names, interned into slot numbers. Parsers of parts
+        # of the same script can share them
+        self.slots: dict[str, int] = {} if slots is None else slots
+        self.openBlockCount: int = 0  # blocks still open when the tokens ran out
 
     def getInstructions(self):
-        foundInstructions: list[Instruction] = []
-        currentInstruction: InstructionConstructionObject | None = None
-
+        return list(self.iterInstructions())
+
+    def getSlot(self, name: str):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.slots)
+        return slot
+
+    def getReferenceArgument(self, reference: str):
+        name = getStoreName(reference)
+        return Argument(
+            ArgumentType.Reference,
+            reference,
+            None if name is None else self.getSlot(name),
+        )
+
+    def iterInstructions(self):
+        """
+        Consumes self.tokens, yielding each instruction as soon
+        as the command that follows it shows up. The instructions
+        inside a "?" block go into its InstructionSet argument,
+        and the block is yielded once its ";" shows up.
+        """
+        currentInstruction: Instruction | None = None
+        stringArgument: str | None = None
         stringMode = False
-
-        def addInstruction(instructions, instruction):
-            if instruction["stringArgumentAccumulation"]:
-                instruction["arguments"].append(
-                    Argument(
-                        value=instruction["stringArgumentAccumulation"],
-                        type=ArgumentType.StringLiteral,
-                    )
-                )
-            instructions.append(
-                Instruction(
-                    commandType=instruction["commandType"],
-                    referenceType=instruction["referenceType"],
-                    reference=instruction["referenceValue"],
-                    arguments=instruction["arguments"],
-                )
-            )
-            return instructions
+        openBlocks: list[tuple[Instruction, list[Instruction]]] = []
 
         for token in self.tokens:
+            tokenType = token.type
+
             # If I run into a command
-            if token.type is TokenType.Command:
-                # Push old instruction into foundInstructions list
-                if currentInstruction is not None and isinstance(
-                    currentInstruction["commandType"], CommandType
-                ):
-                    foundInstructions = addInstruction(
-                        foundInstructions, currentInstruction
-                    )
+            if tokenType is TokenType.Command:
+                # Hand the old instruction over
+                if currentInstruction is not None:
+                    if stringArgument is not None:
+                        finishInstruction(currentInstruction, stringArgument)
+                    if openBlocks:
+                        openBlocks[-1][1].append(currentInstruction)
+                    else:
+                        yield currentInstruction
+
+                stringArgument = None
+                stringMode = False
+                commandType = COMMANDTOKENTEXT_COMMANDTYPE_MAP[token.text]
+                if commandType is CommandType.Ignore:
+                    # comments don't make instructions, and
+                    # nothing that follows them counts
                     currentInstruction = None
+                    continue
 
                 # Start a new instruction
-                if currentInstruction is None:
-                    currentInstruction = {
-                        "referenceType": None,
-                        "referenceValue": None,
-                        "arguments": [],
-                        "commandType": COMMANDTOKENTEXT_COMMANDTYPE_MAP[token.text],
-                        "stringArgumentAccumulation": None,
-                    }
-
-            if not currentInstruction:
+                currentInstruction = Instruction(
+                    commandType=commandType, line=token.line
+                )
+                continue
+
+            # If a block ends, so does the instruction before it
+            if tokenType is TokenType.MultilineBlockEnd and openBlocks:
+                block, body = openBlocks.pop()
+                if currentInstruction is not None:
+                    finishInstruction(currentInstruction, stringArgument)
+                    body.append(currentInstruction)
+                block.arguments.append(Argument(ArgumentType.InstructionSet, body))
+                if openBlocks:
+                    openBlocks[-1][1].append(block)
+                else:
+                    yield block
+                currentInstruction = None
+                stringArgument = None
+                stringMode = False
+                continue
+
+            if currentInstruction is None:
                 continue
 
             # If I run into a reference
-            if token.type is TokenType.Reference:
-                if currentInstruction["commandType"] is CommandType.SetGlobal:
-                    currentInstruction["referenceType"] = ReferenceType.Store
-                    currentInstruction["referenceValue"] = token.text
-                if currentInstruction["commandType"] is CommandType.RunAction:
-                    currentInstruction["referenceType"] = ReferenceType.Operation
-                    if not currentInstruction["referenceValue"]:
-                        currentInstruction["referenceValue"] = token.text
+            if tokenType is TokenType.Reference:
+                if currentInstruction.commandType is CommandType.SetGlobal:
+                    if not currentInstruction.reference:
+                        name = token.text
+                        currentInstruction.referenceType = ReferenceType.Store
+                        currentInstruction.reference = name
+                        if name.startswith(STORE_PREFIXES):
+                            name = getStoreName(name)
+                        currentInstruction.slot = self.getSlot(name)
                     else:
-                        currentInstruction["arguments"].append(
-                            Argument(type=ArgumentType.Reference, value=token.text)
+                        currentInstruction.arguments.append(
+                            self.getReferenceArgument(token.text)
                         )
-
-                if currentInstruction["commandType"] is CommandType.ShellEnter:
-                    if currentInstruction["stringArgumentAccumulation"] is None:
-                        currentInstruction["stringArgumentAccumulation"] = ""
-                    currentInstruction["stringArgumentAccumulation"] += token.text
+                elif currentInstruction.commandType is CommandType.RunAction:
+                    currentInstruction.referenceType = ReferenceType.Operation
+                    if not currentInstruction.reference:
+                        currentInstruction.reference = token.text
+                    else:
+                        reference = token.text
+                        currentInstruction.arguments.append(
+                            self.getReferenceArgument(reference)
+                            if reference.startswith(STORE_PREFIXES)
+                            else Argument(ArgumentType.Reference, reference)
+                        )
+                elif currentInstruction.commandType is CommandType.Condition:
+                    reference = token.text
+                    currentInstruction.arguments.append(
+                        self.getReferenceArgument(reference)
+                        if reference.startswith(STORE_PREFIXES)
+                        else Argument(ArgumentType.Reference, reference)
+                    )
+                continue
 
             # Handle strings
-            if token.type is TokenType.StringBlockStart:
+            if tokenType is TokenType.StringBlockStart:
                 stringMode = True
-                currentInstruction["stringArgumentAccumulation"] = None  # just in case
+                stringArgument = ""
+                continue
 
-            if stringMode and token.type == TokenType.Literal:
-                if not currentInstruction["stringArgumentAccumulation"]:
-                    currentInstruction["stringArgumentAccumulation"] = ""
+            if tokenType is TokenType.StringBlockEnd:
+                stringMode = False
+                currentInstruction.arguments.append(
+                    Argument(ArgumentType.StringLiteral, stringArgument or "")
+                )
+                stringArgument = None
+                continue
 
-                currentInstruction["stringArgumentAccumulation"] += token.text
+            # Conditions open a block that holds the instructions after them
+            if tokenType is TokenType.MultilineBlockStart:
+                if currentInstruction.commandType is CommandType.Condition:
+                    finishInstruction(currentInstruction, stringArgument)
+                    openBlocks.append((currentInstruction, []))
+                    currentInstruction = None
+                    stringArgument = None
+                    stringMode = False
+                continue
 
-            if token.type is TokenType.StringBlockEnd:
-                stringMode = False
+            if tokenType is not TokenType.Literal:
+                continue
 
-            if (
-                not stringMode
-                and token.type == TokenType.Literal
-                and isNumber(token.text)
-            ):
-                currentInstruction["arguments"].append(
-                    Argument(type=ArgumentType.NumberLiteral, value=token.text)
+            # Shell lines arrive as a single literal, and
+            # literals outside of strings are numbers
+            if stringMode or currentInstruction.commandType is CommandType.ShellEnter:
+                stringArgument = (stringArgument or "") + token.text
+            else:
+                currentInstruction.arguments.append(
+                    Argument(ArgumentType.NumberLiteral, token.text)
                 )
 
-        if currentInstruction is not None and isinstance(
-            currentInstruction["commandType"], CommandType
-        ):
-            foundInstructions = addInstruction(foundInstructions, currentInstruction)
-        return foundInstructions
+        if currentInstruction is not None:
+            finishInstruction(currentInstruction, stringArgument)
+            if openBlocks:
+                openBlocks[-1][1].append(currentInstruction)
+            else:
+                yield currentInstruction
+
+        # blocks left open run until the end of the script
+        self.openBlockCount = len(openBlocks)
+        while openBlocks:
+            block, body = openBlocks.pop()
+            block.arguments.append(Argument(ArgumentType.InstructionSet, body))
+            if openBlocks:
+                openBlocks[-1][1].append(block)
+            else:
+                yield block
+
+
+def finishInstruction(instruction: Instruction, stringArgument: str | None):
+    # a string that was never closed still counts
+    if stringArgument is not None:
+        instruction.arguments.append(
+            Argument(ArgumentType.StringLiteral, stringArgument)
+        )
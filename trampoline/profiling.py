@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+from typing import Iterable
+
+from parsing import Instruction
+
+
+class NullMeasurement:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+NULL_MEASUREMENT = NullMeasurement()
+
+
+class NullProfiler:
+    """
+    A profiler that doesn't record anything. It's what runs use
+    when --profile is off, so every hook costs one method call.
+    """
+
+    enabled = False
+
+    def measure(self, name: str, instruction: Instruction | None = None):
+        return NULL_MEASUREMENT
+
+    def measureIterable(self, name: str, iterable: Iterable):
+        return iterable
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Measurement:
+    def __init__(self, profiler: "Profiler", name: str, instruction):
+        self.profiler = profiler
+        self.name = name
+        self.instruction = instruction
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_):
+        self.profiler.record(
+            self.name, self.start, time.perf_counter_ns(), self.instruction
+        )
+        return False
+
+
+class Profiler(NullProfiler):
+    """
+    Records how long each phase of a run and each instruction
+    takes, using the monotonic performance counter.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.origin: int = time.perf_counter_ns()
+        self.events: list[dict] = []
+        self.lock = threading.Lock()
+        self.nestedTimes: list[int] = []
+
+    def record(self, name: str, start: int, end: int, instruction=None):
+        event = {
+            "name": name,
+            "start": start - self.origin,
+            "duration": end - start,
+            "thread": threading.get_ident(),
+        }
+        if instruction is not None:
+            event["line"] = instruction.line
+            event["command"] = instruction.commandType.name
+            event["reference"] = instruction.reference
+        with self.lock:
+            self.events.append(event)
+
+    def measure(self, name: str, instruction: Instruction | None = None):
+        return Measurement(self, name, instruction)
+
+    def measureIterable(self, name: str, iterable: Iterable):
+        """
+        Adds up the time spent producing each item of iterable
+        into a single event, which stays up to date even if the
+        run stops early. Time spent in measured iterables it
+        pulls from isn't counted twice.
+        """
+        start = time.perf_counter_ns()
+        self.record(name, start, start)
+        event = self.events[-1]
+
+        iterator = iter(iterable)
+        exhausted = False
+        while not exhausted:
+            self.nestedTimes.append(0)
+            itemStart = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                exhausted = True
+            elapsed = time.perf_counter_ns() - itemStart
+            event["duration"] += elapsed - self.nestedTimes.pop()
+            if self.nestedTimes:
+                self.nestedTimes[-1] += elapsed
+            if not exhausted:
+                yield item
+
+    def getReport(self):
+        phaseTotals: dict[str, float] = {}
+        for event in self.events:
+            phaseTotals[event["name"]] = (
+                phaseTotals.get(event["name"], 0) + event["duration"] / 1e9
+            )
+        return {
+            "phaseSeconds": phaseTotals,
+            "events": [
+                {
+                    **event,
+                    "start": event["start"] / 1e9,
+                    "duration": event["duration"] / 1e9,
+                }
+                for event in self.events
+            ],
+        }
+
+    def getChromeTrace(self):
+        """
+        Returns the events in the Trace Event Format, which
+        chrome://tracing and Perfetto can open.
+        """
+        traceEvents = []
+        for event in self.events:
+            arguments = {
+                key: event[key]
+                for key in ("line", "command", "reference")
+                if key in event
+            }
+            traceEvents.append(
+                {
+                    "name": event["name"],
+                    "cat": "instruction" if arguments else "phase",
+                    "ph": "X",
+                    "ts": event["start"] / 1000,
+                    "dur": event["duration"] / 1000,
+                    "pid": os.getpid(),
+                    "tid": event["thread"],
+                    "args": arguments,
+                }
+            )
+        return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+    def write(self, path: str, format: str = "report"):
+        data = self.getChromeTrace() if format == "trace" else self.getReport()
+        with open(path, "w") as profileFile:
+            json.dump(data, profileFile, indent=2)
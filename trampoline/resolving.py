@@ -0,0 +1,164 @@
+import operator
+from typing import Iterable
+
+from commands import LoweringError
+from facts import Facts
+from parsing import Argument, ArgumentType, CommandType, Instruction, getStoreName
+
+CONDITION_OPERATORS = {"==": operator.eq, "!=": operator.ne}
+FALSE_VALUES = {"", "0", "false", "no"}
+
+
+class GlobalStore:
+    """
+    The values "%" instructions set, kept in the slots the
+    parser interned their names into.
+    """
+
+    def __init__(self):
+        self.values: list[Argument | None] = []
+
+    def get(self, slot: int):
+        if slot < len(self.values):
+            return self.values[slot]
+        return None
+
+    def set(self, slot: int, value: Argument):
+        if slot >= len(self.values):
+            self.values.extend([None] * (slot + 1 - len(self.values)))
+        self.values[slot] = value
+
+
+def resolveArguments(
+    arguments: list[Argument], store: GlobalStore, facts: Facts | None = None
+):
+    """
+    Swaps references to the store for the values they point to,
+    or for facts about the host when the script didn't set them.
+    Returns arguments itself if none of them changed.
+    """
+    resolvedArguments = arguments
+    for index, argument in enumerate(arguments):
+        if argument.slot is None:
+            continue
+        value = store.get(argument.slot)
+        if value is None and facts is not None:
+            fact = facts.get(getStoreName(argument.value))
+            if fact is not None:
+                value = Argument(ArgumentType.StringLiteral, fact)
+        if value is None:
+            continue  # never set, so it stays as it's written
+        if resolvedArguments is arguments:
+            resolvedArguments = list(arguments)
+        resolvedArguments[index] = value
+    return resolvedArguments
+
+
+def foldArguments(arguments: list[Argument]):
+    """
+    Folds the arguments of a "%" instruction into the single
+    value it sets.
+    """
+    if len(arguments) == 1:
+        return arguments[0]
+    text = ""
+    for argument in arguments:
+        if isinstance(argument.value, str):
+            text += argument.value
+    return Argument(ArgumentType.StringLiteral, text)
+
+
+def isConditionTrue(instruction: Instruction, arguments: list[Argument]):
+    """
+    Checks a "?" condition, which is either a single value or two
+    values compared with == or !=. A reference to the store that
+    was never set, and isn't a fact either, is empty, and so false.
+    """
+    values = [
+        "" if argument.slot is not None else argument.value
+        for argument in arguments
+        if argument.type is not ArgumentType.InstructionSet
+    ]
+    if len(values) == 1:
+        return values[0] not in FALSE_VALUES
+    if (
+        len(values) == 3
+        and arguments[1].type is ArgumentType.Reference
+        and values[1] in CONDITION_OPERATORS
+    ):
+        return CONDITION_OPERATORS[values[1]](values[0], values[2])
+    raise LoweringError(
+        f"line {instruction.line}: conditions look like "
+        "'? meta.osType == \"linux\":' or '? meta.tools.git:'",
+        instruction.line,
+    )
+
+
+def getBlockBody(instruction: Instruction):
+    for argument in instruction.arguments:
+        if argument.type is ArgumentType.InstructionSet:
+            return argument.value
+    return []
+
+
+def resolveInstructions(
+    instructions: Iterable[Instruction],
+    store: GlobalStore | None = None,
+    facts: Facts | None = None,
+    keepBlocks: bool = False,
+):
+    """
+    Resolves every reference to the store ahead of time: "%"
+    instructions are folded into the value they set, and the
+    instructions after them get that value instead of the
+    reference. Instructions are copied, never changed.
+
+    "?" blocks are decided here too, with facts about the host.
+    A true block is replaced by the instructions inside it, and
+    a false one is dropped, so neither costs anything to run.
+    With keepBlocks, a true block is kept as a block of its
+    resolved instructions instead, for running a block at a time.
+    """
+    store = store or GlobalStore()
+    for instruction in instructions:
+        try:
+            arguments = resolveArguments(instruction.arguments, store, facts)
+        except LoweringError as error:
+            raise LoweringError(
+                f"line {instruction.line}: {error}", instruction.line
+            ) from None
+
+        if instruction.commandType is CommandType.Condition:
+            if isConditionTrue(instruction, arguments):
+                body = resolveInstructions(
+                    getBlockBody(instruction), store, facts, keepBlocks
+                )
+                if keepBlocks:
+                    block = Argument(ArgumentType.InstructionSet, list(body))
+                    yield copyInstruction(instruction, [block])
+                else:
+                    yield from body
+            continue
+
+        if instruction.commandType is CommandType.SetGlobal:
+            if instruction.slot is None:
+                yield instruction
+                continue
+            value = foldArguments(arguments)
+            store.set(instruction.slot, value)
+            if arguments is not instruction.arguments or len(arguments) > 1:
+                instruction = copyInstruction(instruction, [value])
+        elif arguments is not instruction.arguments:
+            instruction = copyInstruction(instruction, arguments)
+        yield instruction
+
+
+def copyInstruction(instruction: Instruction, arguments: list[Argument]):
+    return Instruction(
+        commandType=instruction.commandType,
+        referenceType=instruction.referenceType,
+        reference=instruction.reference,
+        arguments=arguments,
+        line=instruction.line,
+        slot=instruction.slot,
+    )
@@ -1,45 +1,371 @@
+import os
+from typing import Iterable
+
 import commands
-from computer import ComputerProcess, ShellType
+from computer import (
+    CommandFailure,
+    ComputerProcess,
+    ShellInfo,
+    ShellSession,
+    ShellType,
+    getLastingStateChange,
+)
+from journaling import StepJournal
+from output import OutputSink, PrefixedOutputSink
 from parsing import CommandType, Instruction, ReferenceType
+from profiling import NULL_PROFILER, NullProfiler
+from resolving import getBlockBody
+
+# operations that don't depend on each other, and can run side by side
+INDEPENDENT_OPERATIONS = {"clone"}
+
+# operations the trampoline can do by itself, without a shell
+BUILTIN_OPERATIONS = {"print", "navto"}
+
+# operations that are run again even when the journal says they're done,
+# because the steps after them depend on what they change
+REPLAYED_OPERATIONS = {"navto"}
+
+
+def getArgumentText(instruction: Instruction):
+    text: str = ""
+    for argument in instruction.arguments:
+        if isinstance(argument.value, str):
+            text += argument.value
+    return text
+
+
+def getCommandForInstruction(instruction: Instruction, shellType: ShellType):
+    """
+    Lowers an instruction into a shell command. Returns ""
+    for instructions that don't need the shell.
+    """
+    if instruction.commandType is CommandType.ShellEnter:
+        return getArgumentText(instruction)
+
+    if (
+        instruction.commandType is CommandType.RunAction
+        and instruction.referenceType is ReferenceType.Operation
+    ):
+        operation = commands.OPERATIONS.get(instruction.reference)
+        if operation is None:
+            return ""
+        try:
+            command = operation.lowerArguments(shellType, instruction.arguments)
+        except commands.LoweringError as error:
+            raise commands.LoweringError(
+                f"line {instruction.line}: {error}", instruction.line
+            ) from None
+        return command or ""
+
+    return ""
+
+
+def checkStepKeepsNoState(instruction: Instruction, command: str):
+    """
+    Refuses a "$" line that ends by changing the shell's state, like
+    "$ cd folder" or "$ export NAME=value", where every step runs in a
+    shell of its own and the change would be gone by the next step.
+    """
+    if instruction.commandType is not CommandType.ShellEnter:
+        return
+    word = getLastingStateChange(command)
+    if word is not None:
+        raise commands.LoweringError(
+            f"line {instruction.line}: {word} wouldn't last past this line, "
+            "since each step runs in a shell of its own here. "
+            "use ! navto to change folders, or run with --session or --compiled",
+            instruction.line,
+        )
+
+
+def runInstructions(
+    instructions: Iterable[Instruction],
+    streaming: bool = False,
+    session: bool = False,
+    logPath: str | None = None,
+    jobs: int = 1,
+    shell: ShellInfo | None = None,
+    profiler: NullProfiler = NULL_PROFILER,
+    output: OutputSink | None = None,
+    journal: StepJournal | None = None,
+):
+    ownsOutput = output is None
+    output = output or OutputSink(logPath)
+    try:
+        if jobs > 1:
+            return runInParallel(instructions, jobs, output, shell, profiler)
+        if session:
+            with ShellSession(output, shell) as shellSession:
+                return streamInstructions(instructions, shellSession, profiler, journal)
+        if streaming:
+            return streamInstructions(
+                instructions, ComputerProcess(output, shell), profiler, journal
+            )
+
+        return runInBatches(instructions, ComputerProcess(output, shell), profiler)
+    finally:
+        if ownsOutput:
+            output.close()
 
 
-def runInstructions(instructions: list[Instruction]):
-    computerProcess = ComputerProcess()
+def iterBatches(instructions: Iterable[Instruction]):
+    """
+    Groups instructions into batches: each block makes up a batch
+    of its own, and so do the instructions between blocks. navto
+    makes up one too, since the trampoline does it by itself.
+    """
+    batch: list[Instruction] = []
     for instruction in instructions:
-        if instruction.commandType is CommandType.Ignore:
+        isBlock = instruction.commandType is CommandType.Condition
+        if isBlock or isReplayed(instruction):
+            if batch:
+                yield batch
+                batch = []
+            if isBlock:
+                yield from iterBatches(getBlockBody(instruction))
+            else:
+                yield [instruction]
+            continue
+        batch.append(instruction)
+    if batch:
+        yield batch
+
+
+def runInBatches(
+    instructions: Iterable[Instruction],
+    computerProcess: ComputerProcess,
+    profiler: NullProfiler = NULL_PROFILER,
+):
+    """
+    Runs instructions a batch at a time, with the commands in each
+    batch run together in one process, print included, so the
+    shell's state lasts through it. Directories navto goes to carry
+    over from one batch to the next, and a batch that only prints
+    never starts a shell.
+    """
+    workingDirectory = os.getcwd()
+    shellType = computerProcess.shell.type
+    for batch in iterBatches(instructions):
+        if all(isBuiltinOperation(instruction) for instruction in batch):
+            for instruction in batch:
+                with profiler.measure("builtin", instruction):
+                    workingDirectory = runBuiltin(
+                        instruction, workingDirectory, computerProcess.output
+                    )
             continue
-        if (
-            instruction.commandType is CommandType.RunAction
-            and instruction.referenceType is ReferenceType.Operation
-        ):
-            command: str = ""
-            if instruction.reference == "clone":
-                repoURL: str = ""
-                for argument in instruction.arguments:
-                    if isinstance(argument.value, str):
-                        repoURL += argument.value
-                command = commands.c_clone(computerProcess.shell.type, repoURL) or ""
-
-            if instruction.reference == "print":
-                stringToPrint: str = ""
-                for argument in instruction.arguments:
-                    if isinstance(argument.value, str):
-                        stringToPrint += argument.value
-                command = (
-                    commands.c_print(computerProcess.shell.type, stringToPrint) or ""
+
+        commands: list[str] = []
+        for instruction in batch:
+            with profiler.measure("lower", instruction):
+                command = getCommandForInstruction(instruction, shellType)
+            if command != "":
+                commands.append(command)
+        if not commands:
+            continue
+
+        with profiler.measure("run"):
+            computerProcess.runBatch(commands, workingDirectory)
+
+
+def runScriptFile(
+    path: str,
+    logPath: str | None = None,
+    shell: ShellInfo | None = None,
+    profiler: NullProfiler = NULL_PROFILER,
+    output: OutputSink | None = None,
+):
+    """
+    Runs a compiled script file in one go.
+    """
+    ownsOutput = output is None
+    output = output or OutputSink(logPath)
+    try:
+        with profiler.measure("run"):
+            ComputerProcess(output, shell).runScript(path)
+    finally:
+        if ownsOutput:
+            output.close()
+
+
+def streamInstructions(
+    instructions: Iterable[Instruction],
+    computerProcess: ComputerProcess | None = None,
+    profiler: NullProfiler = NULL_PROFILER,
+    journal: StepJournal | None = None,
+):
+    """
+    Runs each instruction as soon as it's available. With a
+    journal, every completed step is written down, and the steps
+    it already has are skipped until the first one that changed.
+
+    Unless computerProcess keeps its shell running, every step
+    gets a shell of its own, so "$" lines that end by changing the
+    shell's state are refused instead of being quietly lost.
+    """
+    computerProcess = computerProcess or ComputerProcess()
+    workingDirectory = os.getcwd()
+    skipping = journal is not None and len(journal.skippableKeys) > 0
+
+    for instruction in instructions:
+        stepKey = None
+        if journal is not None and instruction.commandType is not CommandType.Ignore:
+            stepKey = journal.getStepKey(instruction)
+            if skipping and journal.hasCompleted(stepKey):
+                if not isReplayed(instruction):
+                    journal.skippedSteps += 1
+                    journal.recordStep(stepKey)
+                    continue
+            elif skipping:
+                skipping = False
+                reportSkippedSteps(journal, computerProcess.output)
+
+        if isBuiltin(instruction, computerProcess):
+            with profiler.measure("builtin", instruction):
+                workingDirectory = runBuiltin(
+                    instruction, workingDirectory, computerProcess.output
+                )
+        else:
+            with profiler.measure("lower", instruction):
+                command = getCommandForInstruction(
+                    instruction, computerProcess.shell.type
+                )
+                if not computerProcess.keepsState:
+                    checkStepKeepsNoState(instruction, command)
+            if command != "":
+                with profiler.measure("run", instruction):
+                    computerProcess.run(command, cwd=workingDirectory)
+
+        if stepKey is not None:
+            journal.recordStep(stepKey)
+
+    if journal is not None:
+        if skipping:
+            reportSkippedSteps(journal, computerProcess.output)
+        journal.finish()
+
+
+def reportSkippedSteps(journal: StepJournal, output: OutputSink):
+    if journal.skippedSteps > 0:
+        steps = "step" if journal.skippedSteps == 1 else "steps"
+        output.write(
+            f"/ skipped {journal.skippedSteps} {steps} that already ran\n".encode()
+        )
+
+
+def isReplayed(instruction: Instruction):
+    return (
+        instruction.commandType is CommandType.RunAction
+        and instruction.reference in REPLAYED_OPERATIONS
+    )
+
+
+def isBuiltinOperation(instruction: Instruction):
+    return (
+        instruction.commandType is CommandType.RunAction
+        and instruction.reference in BUILTIN_OPERATIONS
+    )
+
+
+def isBuiltin(instruction: Instruction, computerProcess: ComputerProcess):
+    if not isBuiltinOperation(instruction):
+        return False
+    if instruction.reference == "navto":
+        # a shell that keeps state has its own idea of where it is
+        return not computerProcess.keepsState
+    return True
+
+
+def runBuiltin(instruction: Instruction, workingDirectory: str, output: OutputSink):
+    """
+    Runs a built-in operation without going through the shell.
+    Returns the working directory for the instructions after it.
+    """
+    match instruction.reference:
+        case "print":
+            output.write(getArgumentText(instruction).encode())
+        case "navto":
+            path = getArgumentText(instruction)
+            newWorkingDirectory = os.path.join(
+                workingDirectory, os.path.expandvars(os.path.expanduser(path))
+            )
+            if not os.path.isdir(newWorkingDirectory):
+                raise CommandFailure(
+                    f"navto {path}", 1, f"{newWorkingDirectory} isn't a directory"
+                )
+            return os.path.normpath(newWorkingDirectory)
+    return workingDirectory
+
+
+def isIndependent(instruction: Instruction):
+    return (
+        instruction.commandType is CommandType.RunAction
+        and instruction.reference in INDEPENDENT_OPERATIONS
+    )
+
+
+def runInParallel(
+    instructions: Iterable[Instruction],
+    jobs: int,
+    output: OutputSink,
+    shell: ShellInfo | None = None,
+    profiler: NullProfiler = NULL_PROFILER,
+):
+    """
+    Runs independent instructions side by side on a pool of
+    workers. Every other instruction is a barrier: it waits for
+    everything before it, and everything after waits for it.
+    """
+    from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+    computerProcess = ComputerProcess(output, shell)
+    shellType = computerProcess.shell.type
+    workingDirectory = os.getcwd()
+
+    def runStep(stepNumber: int, instruction: Instruction, command: str, cwd: str):
+        stepOutput = PrefixedOutputSink(output, f"[{stepNumber}] ")
+        try:
+            with profiler.measure("run", instruction):
+                stepProcess = ComputerProcess(stepOutput, computerProcess.shell)
+                stepProcess.run(command, cwd=cwd)
+        finally:
+            stepOutput.close()
+
+    def waitForSteps(steps: list[Future]):
+        wait(steps)
+        for step in steps:
+            step.result()  # raises the step's failure, if any
+        steps.clear()
+
+    runningSteps: list[Future] = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for stepNumber, instruction in enumerate(instructions, start=1):
+            if isIndependent(instruction):
+                with profiler.measure("lower", instruction):
+                    command = getCommandForInstruction(instruction, shellType)
+                if command == "":
+                    continue
+                runningSteps.append(
+                    pool.submit(
+                        runStep, stepNumber, instruction, command, workingDirectory
+                    )
                 )
+                continue
 
-            if instruction.reference == "navto":
-                path: str = ""
-                for argument in instruction.arguments:
-                    if isinstance(argument.value, str):
-                        path += argument.value
-                command = commands.c_navto(computerProcess.shell.type, path) or ""
+            if isBuiltin(instruction, computerProcess):
+                waitForSteps(runningSteps)
+                with profiler.measure("builtin", instruction):
+                    workingDirectory = runBuiltin(instruction, workingDirectory, output)
+                continue
 
+            with profiler.measure("lower", instruction):
+                command = getCommandForInstruction(instruction, shellType)
+                checkStepKeepsNoState(instruction, command)
             if command == "":
                 continue
-            else:
-                computerProcess.stashCommand(command)
 
-    print(computerProcess.stashedCommands)
-    computerProcess.runStashedCommands()
+            waitForSteps(runningSteps)
+            with profiler.measure("run", instruction):
+                computerProcess.run(command, cwd=workingDirectory)
+
+        waitForSteps(runningSteps)
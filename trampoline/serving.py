@@ -0,0 +1,395 @@
+import json
+import os
+import struct
+import sys
+from typing import Callable
+
+from misc import TRAMPOLINE_VERSION, getCacheDirectory, getShellCacheKey
+
+SOCKET_NAME = "serve.sock"
+WARM_SCRIPT_COUNT = 32  # parsed scripts the server keeps in memory
+REQUEST_TIMEOUT = 5.0  # seconds a client gets to send its request
+REQUEST_HEADER = struct.Struct("!I")  # how long the request is
+STDIO_FILE_DESCRIPTORS = [0, 1, 2]
+
+# modules a run needs, loaded once by the server instead of by every run
+WARM_MODULES = [
+    "caching",
+    "commands",
+    "compiling",
+    "computer",
+    "concurrent.futures",
+    "facts",
+    "journaling",
+    "output",
+    "parsing",
+    "platform",
+    "profiling",
+    "resolving",
+    "rich",
+    "running",
+    "shutil",
+    "sources",
+    "subprocess",
+    "tempfile",
+    "tokenization",
+]
+
+
+class ServeFailure(Exception):
+    pass
+
+
+def getSocketPath():
+    return getCacheDirectory() / SOCKET_NAME
+
+
+def canServe():
+    import socket
+
+    return hasattr(socket, "AF_UNIX") and hasattr(socket, "send_fds")
+
+
+def sendMessage(connection, **message):
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+def getUmask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def getResourceLimits():
+    import resource
+
+    return {
+        name: resource.getrlimit(getattr(resource, name))
+        for name in dir(resource)
+        if name.startswith("RLIMIT_")
+    }
+
+
+def submitRun(options: dict):
+    """
+    Hands a run over to `trampoline serve`, along with this
+    process' working directory, environment, umask, resource
+    limits, and stdin, stdout and stderr, which the run reads and
+    writes directly. Returns the run's exit code, or None if
+    there's no server to take it.
+
+    A served run has no controlling terminal, so commands that
+    ask for passwords on one, like ssh, sudo or git, can't.
+    Runs with a terminal on stdin are never handed over.
+    """
+    socketPath = getSocketPath()
+    if not os.path.exists(socketPath):
+        return None  # the quick way out, without loading socket
+    if not canServe() or sys.stdin is None or sys.stdin.isatty():
+        return None
+
+    import socket
+
+    request = json.dumps(
+        {
+            "version": TRAMPOLINE_VERSION,
+            "cwd": os.getcwd(),
+            "environment": dict(os.environ),
+            "umask": getUmask(),
+            "limits": getResourceLimits(),
+            "shellKey": getShellCacheKey(),
+            "options": options,
+        }
+    ).encode()
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(socketPath))
+        header = REQUEST_HEADER.pack(len(request))
+        socket.send_fds(connection, [header], STDIO_FILE_DESCRIPTORS)
+        connection.sendall(request)
+    except OSError:
+        connection.close()
+        return None  # a server that's gone, or one that can't take our stdio
+
+    with connection:
+        return followRun(connection)
+
+
+def followRun(connection):
+    """
+    Waits for a submitted run to finish, and returns its exit
+    code. Ctrl+C is passed along to the run.
+    """
+    import signal
+
+    messages = connection.makefile("rb")
+    processGroup = None
+    while True:
+        try:
+            line = messages.readline()
+        except KeyboardInterrupt:
+            if processGroup is not None:
+                try:
+                    os.killpg(processGroup, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+            continue
+
+        if not line:
+            print("/ yikes! the server stopped before the run finished.")
+            return 1
+        message = json.loads(line)
+        if "fallback" in message:
+            return None
+        if "processGroup" in message:
+            processGroup = message["processGroup"]
+        if "exitCode" in message:
+            return message["exitCode"]
+
+
+def serve(runRequest: Callable[[dict], int], shellInfo=None, socketPath=None):
+    """
+    Runs the server: a resident process that keeps the interpreter,
+    the modules runs need, the detected shell and recently parsed
+    scripts warm. Every run submitted to it is forked off with all
+    of that already loaded, so it only pays for what it runs.
+
+    Runs that pick their shell, with --shell or YAY_SHELL, get
+    that one. The others get the server's shell if it was picked
+    for the server, or if detection would find the same one for
+    them, and are sent back to run by themselves otherwise.
+    Resource limits the server can't raise its own to stay lower.
+    """
+    import signal
+    import socket
+
+    from computer import getShell
+
+    if not canServe():
+        raise ServeFailure(
+            "/ hmm. serving needs Unix sockets, which this system lacks."
+        )
+
+    socketPath = socketPath or getSocketPath()
+    shellKey = None  # what detected the server's shell, if it was detected
+    if shellInfo is None and "YAY_SHELL" not in os.environ:
+        shellKey = getShellCacheKey()
+    try:
+        shellInfo = shellInfo or getShell()
+    except ValueError as error:
+        raise ServeFailure(f"/ hmm. {error}.")
+    for module in WARM_MODULES:
+        __import__(module)
+
+    server = bindSocket(socketPath)
+
+    def reapChildren(*_):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0] != 0:
+                pass
+        except ChildProcessError:
+            pass
+
+    def stop(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGCHLD, reapChildren)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f"/ serving runs on {socketPath} with {shellInfo.type.name}", flush=True)
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                handleConnection(connection, server, runRequest, shellInfo, shellKey)
+    except KeyboardInterrupt:
+        print("/ bye!")
+    finally:
+        server.close()
+        try:
+            os.unlink(socketPath)
+        except OSError:
+            pass
+
+
+def bindSocket(socketPath):
+    import socket
+
+    if os.path.exists(socketPath):
+        # a server that's still around keeps its socket
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(socketPath))
+        except OSError:
+            os.unlink(socketPath)  # left behind by one that isn't
+        else:
+            raise ServeFailure(f"/ hmm. something is already serving on {socketPath}.")
+        finally:
+            probe.close()
+
+    socketPath.parent.mkdir(parents=True, exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(str(socketPath))
+    except OSError as error:
+        server.close()
+        raise ServeFailure(f"/ hmm. couldn't serve on {socketPath}: {error.strerror}.")
+    os.chmod(socketPath, 0o600)  # only for whoever started the server
+    server.listen()
+    return server
+
+
+def handleConnection(connection, server, runRequest, shellInfo, shellKey=None):
+    """
+    Reads a request, and forks a process to run it.
+    """
+    import socket
+
+    fileDescriptors: list[int] = []
+    try:
+        connection.settimeout(REQUEST_TIMEOUT)
+        header, fileDescriptors, _, _ = socket.recv_fds(
+            connection, REQUEST_HEADER.size, len(STDIO_FILE_DESCRIPTORS)
+        )
+        if len(header) != REQUEST_HEADER.size or len(fileDescriptors) != len(
+            STDIO_FILE_DESCRIPTORS
+        ):
+            return
+        (length,) = REQUEST_HEADER.unpack(header)
+        request = json.loads(receiveExactly(connection, length))
+        connection.settimeout(None)
+
+        if request.get("version") != TRAMPOLINE_VERSION:
+            sendMessage(connection, fallback="version")
+            return
+        if not (
+            isinstance(request.get("options"), dict)
+            and isinstance(request.get("cwd"), str)
+            and isinstance(request.get("environment"), dict)
+        ):
+            return
+
+        options = request["options"]
+        if not options.get("shell") and "YAY_SHELL" not in request["environment"]:
+            if shellKey is not None and request.get("shellKey") != shellKey:
+                # detection could find a different shell for the client
+                sendMessage(connection, fallback="shell")
+                return
+            options["shellInfo"] = shellInfo
+        warmScripts(request)
+
+        if os.fork() == 0:
+            exitCode = 1
+            try:
+                server.close()
+                exitCode = runForked(connection, request, fileDescriptors, runRequest)
+            finally:
+                os._exit(exitCode)
+    except (OSError, ValueError):
+        pass  # a client that went away, or never made sense
+    finally:
+        for fileDescriptor in fileDescriptors:
+            os.close(fileDescriptor)
+
+
+def receiveExactly(connection, size: int):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ValueError("the request was cut short")
+        data += chunk
+    return bytes(data)
+
+
+def warmScripts(request: dict):
+    """
+    Parses the script a request runs into memory, unless it's
+    already there, so the next run of it can skip parsing.
+    """
+    from caching import InstructionCache, warmInstructions
+    from parsing import Parser
+    from sources import isStdin, openScriptSource
+    from tokenization import iterTokensFromChunks
+
+    options = request["options"]
+    files = options.get("files", [])
+    if len(files) != 1 or isStdin(files[0]) or options.get("noCache"):
+        return
+    path = os.path.join(request["cwd"], files[0])
+    if not os.path.isfile(path):
+        return  # batches and globs are left to the run
+
+    try:
+        with openScriptSource(path) as source:
+            scriptHash = source.getHash()
+            instructions = warmInstructions.pop(scriptHash, None)
+            if instructions is None:
+                instructions = InstructionCache().load(scriptHash)
+            if instructions is None:
+                tokens = iterTokensFromChunks(source.iterChunks())
+                instructions = Parser(tokens).getInstructions()
+    except Exception:
+        return  # the run itself will say what's wrong
+
+    warmInstructions[scriptHash] = instructions  # now the most recent one
+    while len(warmInstructions) > WARM_SCRIPT_COUNT:
+        del warmInstructions[next(iter(warmInstructions))]
+
+
+def runForked(connection, request, fileDescriptors, runRequest):
+    """
+    Runs a request in a process forked off the server, as if it
+    were the client: with its stdio, working directory, environment,
+    umask and resource limits. Returns the run's exit code.
+    """
+    import signal
+
+    # a session of its own, so Ctrl+C can reach the run and its
+    # commands, and the client's terminal isn't a controlling one
+    os.setsid()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    for target, fileDescriptor in zip(STDIO_FILE_DESCRIPTORS, fileDescriptors):
+        os.dup2(fileDescriptor, target)
+        os.close(fileDescriptor)
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+    sendMessage(connection, processGroup=os.getpid())
+    exitCode = 1
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["environment"])
+        os.umask(request.get("umask", getUmask()))
+        setResourceLimits(request.get("limits", {}))
+
+        exitCode = runRequest(request["options"])
+    except KeyboardInterrupt:
+        exitCode = 130
+    except SystemExit as exit:
+        exitCode = exit.code if isinstance(exit.code, int) else 1
+    except BaseException:
+        import traceback
+
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sendMessage(connection, exitCode=exitCode)
+    return exitCode
+
+
+def setResourceLimits(limits: dict):
+    import resource
+
+    for name, (soft, hard) in limits.items():
+        try:
+            resource.setrlimit(getattr(resource, name), (soft, hard))
+        except (AttributeError, ValueError, OSError):
+            pass  # one the server can't raise its own limit to
@@ -0,0 +1,177 @@
+import gzip
+import mmap
+import os
+import sys
+from typing import BinaryIO, Iterable
+
+from caching import getDataHash
+
+STDIN_NAME = "-"
+GZIP_SUFFIX = ".yay.gz"
+CHUNK_SIZE = 256 * 1024  # bytes
+HASH_BLOCK_SIZE = 1024 * 1024  # bytes
+
+
+def decodeChunk(chunk: bytes):
+    text = chunk.decode("utf-8")
+    if "\r" in text:
+        # the same newlines text mode would give
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def iterLineChunks(stream: BinaryIO, chunkSize: int = CHUNK_SIZE):
+    """
+    Reads stream in chunks that always end at the end of a line,
+    so a line is never split between two of them.
+    """
+    remainder = b""
+    while True:
+        block = stream.read(chunkSize)
+        if not block:
+            break
+        block = remainder + block
+        lineEnd = block.rfind(b"\n") + 1
+        if lineEnd == 0:
+            remainder = block
+            continue
+        remainder = block[lineEnd:]
+        yield decodeChunk(block[:lineEnd])
+    if remainder:
+        yield decodeChunk(remainder)
+
+
+class ScriptSource:
+    """
+    Where a script's text comes from. Sources hand the text out
+    in chunks of whole lines, so nothing has to hold all of it.
+    """
+
+    name: str = ""
+
+    def getHash(self):
+        """
+        Returns the hash the caches know the script by, or None if
+        the source can only be read once.
+        """
+        return None
+
+    def iterChunks(self) -> Iterable[str]:
+        return iter(())
+
+    def read(self):
+        return "".join(self.iterChunks())
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        return False
+
+
+class FileSource(ScriptSource):
+    """
+    A script file, mapped into memory instead of read into it.
+    """
+
+    def __init__(self, path: str):
+        self.name: str = path
+        self.file = open(path, "rb")
+        self.map = None
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            pass  # empty files can't be mapped
+
+    def getHash(self):
+        return getDataHash([self.map] if self.map is not None else [])
+
+    def iterChunks(self):
+        if self.map is None:
+            return
+        size = len(self.map)
+        start = 0
+        while start < size:
+            end = self.map.find(b"\n", min(start + CHUNK_SIZE, size) - 1) + 1
+            if end == 0:
+                end = size
+            yield decodeChunk(self.map[start:end])
+            start = end
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class GzipSource(ScriptSource):
+    """
+    A gzipped script, decompressed a chunk at a time as it's read.
+    """
+
+    def __init__(self, path: str):
+        self.name: str = path
+
+    def getHash(self):
+        # the compressed bytes identify the script just as well, and
+        # they're much quicker to go through
+        with open(self.name, "rb") as file:
+            return getDataHash(iter(lambda: file.read(HASH_BLOCK_SIZE), b""))
+
+    def iterChunks(self):
+        with gzip.open(self.name, "rb") as file:
+            yield from iterLineChunks(file)
+
+
+class StreamSource(ScriptSource):
+    """
+    A script piped in, which can only be read once.
+    """
+
+    def __init__(self, stream: BinaryIO, name: str = STDIN_NAME):
+        self.name: str = name
+        self.stream: BinaryIO = stream
+
+    def iterChunks(self):
+        yield from iterLineChunks(self.stream)
+
+    def close(self):
+        self.stream.close()
+
+
+def detachStdin():
+    """
+    Takes stdin over for reading a script, and points the real
+    stdin at the null device, so the commands the script runs
+    can't read the rest of it.
+    """
+    stream = os.fdopen(os.dup(sys.stdin.fileno()), "rb")
+    nullDevice = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(nullDevice, sys.stdin.fileno())
+    os.close(nullDevice)
+    return stream
+
+
+def isStdin(file: str):
+    return file == STDIN_NAME
+
+
+def isGzipped(file: str):
+    return file.endswith(GZIP_SUFFIX)
+
+
+def openScriptSource(file: str):
+    """
+    Opens the right kind of source for file: "-" for stdin, a
+    .yay.gz file, or a plain .yay file.
+    """
+    if isStdin(file):
+        return StreamSource(detachStdin())
+    if isGzipped(file):
+        return GzipSource(file)
+    return FileSource(file)
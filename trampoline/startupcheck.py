@@ -0,0 +1,99 @@
+"""
+Checks that the trampoline still starts quickly.
+
+Times `main.py --version` and a tiny `main.py run` against a bare
+interpreter, and fails if either costs more than the budget or if
+the run path ends up importing typer or rich.
+
+    python startupcheck.py [budget in milliseconds]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+DEFAULT_BUDGET_MILLISECONDS = 60.0
+RUNS = 10
+HEAVY_MODULES = ["typer", "click", "rich"]
+
+here = Path(__file__).resolve().parent
+
+
+def timeCommand(arguments: list[str], environment: dict[str, str]):
+    """
+    Returns the fastest of RUNS runs of a command, in milliseconds.
+    """
+    fastest = float("inf")
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run(
+            arguments,
+            cwd=here,
+            env=environment,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest * 1000
+
+
+def getImportedHeavyModules(scriptPath: str, environment: dict[str, str]):
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, main\n"
+            f"main.fastMain(['run', {scriptPath!r}, '--stream', '--no-cache'])\n"
+            f"loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+            "print('\\nloaded:', *loaded)",
+        ],
+        cwd=here,
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return output.stdout.splitlines()[-1].split()[1:]
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET_MILLISECONDS
+
+    with tempfile.TemporaryDirectory() as directory:
+        environment = {**os.environ, "YAY_CACHE_DIR": directory}
+        scriptPath = os.path.join(directory, "startup.yay")
+        with open(scriptPath, "w") as scriptFile:
+            scriptFile.write('! print "hi"\n')
+
+        baseline = timeCommand([sys.executable, "-c", "pass"], environment)
+        results = {
+            "--version": timeCommand(
+                [sys.executable, "main.py", "--version"], environment
+            ),
+            "run": timeCommand(
+                [sys.executable, "main.py", "run", scriptPath, "--stream"],
+                environment,
+            ),
+        }
+        heavyModules = getImportedHeavyModules(scriptPath, environment)
+
+    failed = False
+    print(f"interpreter: {baseline:.1f}ms")
+    for name, milliseconds in results.items():
+        overhead = milliseconds - baseline
+        verdict = "ok" if overhead <= budget else "over budget!"
+        failed = failed or overhead > budget
+        print(f"{name}: {milliseconds:.1f}ms (+{overhead:.1f}ms) {verdict}")
+
+    if heavyModules:
+        failed = True
+        print(f"run imported {', '.join(heavyModules)}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
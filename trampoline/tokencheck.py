@@ -0,0 +1,188 @@
+"""
+Checks that tokenizing a script in chunks matches tokenizing it
+whole, for every way of cutting it into chunks, along with a few
+scripts whose instructions are known.
+
+Random scripts are made out of pieces that open and close strings
+and comment blocks, so chunks often end inside one of them.
+
+    python tokencheck.py [seed] [scripts]
+"""
+
+import io
+import os
+import random
+import sys
+import tempfile
+
+import sources
+from parsing import Instruction, Parser
+from tokenization import Tokenizer, iterTokensFromChunks
+
+DEFAULT_SCRIPTS = 1000
+MAX_CHUNK_SIZE = 40  # bytes
+FILE_EVERY = 10  # scripts, since writing a file costs more than the rest
+
+PIECES = [
+    "/:",
+    "/:",
+    "/ :",
+    ";",
+    "i'll",
+    "/",
+    '! print "a b"',
+    "$ echo hi",
+    '% title "open',
+    'closed" word',
+    "! clone 'url' depth 1",
+    ": ",
+    "word;",
+    "one; two",
+    '"',
+    "'",
+    "  ",
+    "/ comment",
+    "12 3.5",
+    "word:",
+    "? word:",
+    "? 'open",
+    "\r",
+    "\t",
+    '""',
+]
+
+# scripts, and what their instructions should be:
+# (command, reference, arguments, line), with blocks' bodies nested
+CASES = {
+    "a string across lines": (
+        '! print "one\ntwo"\n$ echo hi\n',
+        [
+            ("RunAction", "print", ["one\ntwo"], 1),
+            ("ShellEnter", None, ["echo hi"], 3),
+        ],
+    ),
+    "a comment block": (
+        "/:\n    it's a comment\n;\n! navto folder\n",
+        [("RunAction", "navto", ["folder"], 4)],
+    ),
+    "a colon that ends a word": (
+        "! navto C:\n! print Warning:\n",
+        [
+            ("RunAction", "navto", ["C:"], 1),
+            ("RunAction", "print", ["Warning:"], 2),
+        ],
+    ),
+    "a comment block in a ? block": (
+        "? meta.osType == 'windows':\n"
+        "    /:\n"
+        "        remove the folder; then reboot, don't forget\n"
+        "    ;\n"
+        "    $ echo windows\n"
+        ";\n"
+        "$ echo after\n",
+        [
+            (
+                "Condition",
+                None,
+                [
+                    "meta.osType",
+                    "==",
+                    "windows",
+                    [("ShellEnter", None, ["echo windows"], 5)],
+                ],
+                1,
+            ),
+            ("ShellEnter", None, ["echo after"], 7),
+        ],
+    ),
+}
+
+
+def summarize(instructions: list[Instruction]):
+    return [
+        (
+            instruction.commandType.name,
+            instruction.reference,
+            [
+                (
+                    summarize(argument.value)
+                    if isinstance(argument.value, list)
+                    else argument.value
+                )
+                for argument in instruction.arguments
+            ],
+            instruction.line,
+        )
+        for instruction in instructions
+    ]
+
+
+def describeTokens(tokens):
+    return [(token.type, token.text, token.line) for token in tokens]
+
+
+def iterChunks(text: str, chunkSize: int):
+    return sources.iterLineChunks(io.BytesIO(text.encode()), chunkSize)
+
+
+def checkCases():
+    failed = False
+    for name, (text, expected) in CASES.items():
+        instructions = summarize(Parser(Tokenizer(text).iterTokens()).getInstructions())
+        problem = None
+        if instructions != expected:
+            problem = f"got {instructions}"
+        for chunkSize in range(1, len(text.encode()) + 1):
+            if problem is not None:
+                break
+            tokens = iterTokensFromChunks(iterChunks(text, chunkSize))
+            if summarize(Parser(tokens).getInstructions()) != expected:
+                problem = f"differs in chunks of {chunkSize} bytes"
+        print(f"{name}: {'ok' if problem is None else problem}")
+        failed = failed or problem is not None
+    return not failed
+
+
+def checkRandomScripts(seed: int, scripts: int):
+    generator = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "script.yay")
+        for scriptNumber in range(scripts):
+            lines = [
+                " ".join(
+                    generator.choice(PIECES) for _ in range(generator.randint(0, 3))
+                )
+                for _ in range(generator.randint(0, 30))
+            ]
+            text = "\n".join(lines) + generator.choice(["\n", ""])
+            normalized = text.replace("\r\n", "\n").replace("\r", "\n")
+            expected = describeTokens(Tokenizer(normalized).iterTokens())
+
+            chunkSize = generator.randint(1, MAX_CHUNK_SIZE)
+            tokens = describeTokens(iterTokensFromChunks(iterChunks(text, chunkSize)))
+            if tokens == expected and scriptNumber % FILE_EVERY == 0:
+                # and the same through a mapped file
+                with open(path, "wb") as scriptFile:
+                    scriptFile.write(text.encode())
+                sources.CHUNK_SIZE = chunkSize
+                with sources.FileSource(path) as source:
+                    tokens = describeTokens(iterTokensFromChunks(source.iterChunks()))
+            if tokens != expected:
+                print(f"mismatch in script {scriptNumber}, chunks of {chunkSize}:")
+                print(repr(text))
+                return False
+
+    print(f"ok: {scripts} random scripts")
+    return True
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    scripts = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SCRIPTS
+    passed = checkCases()
+    passed = checkRandomScripts(seed, scripts) and passed
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
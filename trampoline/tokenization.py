@@ -1,8 +1,7 @@
 import re
+from array import array
 from enum import Enum, auto
-from typing import Literal
-
-from misc import isNumber, isWhiteSpace
+from typing import Iterable, Literal
 
 
 class TokenType(Enum):
@@ -20,10 +19,79 @@ class TokenType(Enum):
 
 
 class Token:
-    def __init__(self, type: TokenType, text: str):
+    """
+    A token, kept as a (start, end) span of the text it came
+    from. The token's own text is only sliced out on demand.
+    """
+
+    __slots__ = ("type", "source", "start", "end", "line")
+
+    def __init__(
+        self,
+        type: TokenType,
+        source: str,
+        start: int = 0,
+        end: int | None = None,
+        line: int = 0,
+    ):
         self.type = type
-        self.text = text
-
+        self.source = source
+        self.start = start
+        self.end = len(source) if end is None else end
+        self.line = line  # counting from 1
+
+    @property
+    def text(self):
+        return self.source[self.start : self.end]
+
+    def getColumn(self):
+        """
+        Returns the column the token starts at, counting from 1.
+        """
+        return self.start - self.source.rfind("\n", 0, self.start)
+
+
+class TokenStream:
+    """
+    A compact list of tokens that all come from the same text,
+    packed into flat arrays of type codes, offsets and lines.
+    Token objects are only built when they're looked at.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.types = array("B")
+        self.starts = array("I")
+        self.ends = array("I")
+        self.lines = array("I")
+
+    def append(self, token: Token):
+        self.types.append(token.type.value)
+        self.starts.append(token.start)
+        self.ends.append(token.end)
+        self.lines.append(token.line)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index: int):
+        return Token(
+            TOKEN_TYPES_BY_VALUE[self.types[index]],
+            self.source,
+            self.starts[index],
+            self.ends[index],
+            self.lines[index],
+        )
+
+    def __iter__(self):
+        source = self.source
+        for typeValue, start, end, line in zip(
+            self.types, self.starts, self.ends, self.lines
+        ):
+            yield Token(TOKEN_TYPES_BY_VALUE[typeValue], source, start, end, line)
+
+
+TOKEN_TYPES_BY_VALUE = {tokenType.value: tokenType for tokenType in TokenType}
 
 CHUNK_TOKEN_TYPE_MAP = {
     "commands": {
@@ -31,10 +99,11 @@ CHUNK_TOKEN_TYPE_MAP = {
         "!": TokenType.Command,
         "$": TokenType.Command,
         "/": TokenType.Command,
+        "?": TokenType.Command,
     },
     "stringBlockStart": {
         '"': TokenType.StringBlockStart,
-        "'": TokenType.StringBlockEnd,
+        "'": TokenType.StringBlockStart,
     },
     "stringBlockEnd": {
         '"': TokenType.StringBlockEnd,
@@ -55,154 +124,313 @@ BlockTokenType = Literal[
     TokenType.StringBlockEnd,
 ]
 
+COMMAND_CHARACTERS = frozenset(CHUNK_TOKEN_TYPE_MAP["commands"])
+QUOTE_CHARACTERS = frozenset(CHUNK_TOKEN_TYPE_MAP["stringBlockStart"])
+MULTILINE_BLOCK_START = ":"
+CONDITION_CHARACTER = "?"  # the only command whose words can end in a block start
+MULTILINE_BLOCK_END = ";"
+COMMENT_CHARACTER = "/"
+
+# precompiled character classes for the scanner
+WHITESPACE_PATTERN = re.compile(r"[^\S\n]*")
+WORD_PATTERN = re.compile(r"\S+")
+NUMBER_PATTERN = re.compile(
+    r"[+-]?(?:\d+(?:_\d+)*(?:\.(?:\d+(?:_\d+)*)?)?|\.\d+(?:_\d+)*)"
+    r"(?:[eE][+-]?\d+(?:_\d+)*)?"
+)
+# "/ a comment", or "/:" to start a block of them
+COMMENT_PATTERN = re.compile(r"/(?:\s*(:)\s*$|\s|$)")
+# and a ";" alone on its line to end it
+COMMENT_BLOCK_END_PATTERN = re.compile(r"^[^\S\n]*;[^\S\n]*$", re.MULTILINE)
+
+
+class OpenString:
+    """
+    A string a scan ended in, so another scan can pick it up.
+    """
+
+    __slots__ = ("quote", "start", "line", "isConditionLine")
+
+    def __init__(self, quote: str, start: int, line: int, isConditionLine: bool):
+        self.quote = quote
+        self.start = start  # where its text starts
+        self.line = line  # the line it was opened on
+        self.isConditionLine = isConditionLine
+
 
 class Tokenizer:
     def __init__(self, text: str):
         self.text = text
-        self.chunks = text.split(" ")
-        self.tokens: list[Token] = []
+        self.blockStartingTokenType: None | BlockTokenType = None
+        # where the line an unfinished comment block starts on starts
+        self.openCommentStart: int | None = None
+        # the string a scan ended in, if it was left open for another scan
+        self.openString: OpenString | None = None
 
     def getLines(self):
         lines = self.text.splitlines()
         return [line for line in lines if len(line) != 0]
 
     def getTokens(self):
-        blockStartingTokenType: None | BlockTokenType = None
-        tokens = []
-
-        for line in self.getLines():
-            isFirstChunkInLine = True
-            lineTokens: list[Token] = []
-
-            chunks = re.split(r"(\S+)", line)
-            tokenContent = ""
+        tokens = TokenStream(self.text)
+        for token in self.iterTokens():
+            tokens.append(token)
+        return tokens
 
-            for chunk in chunks:
-                if not chunk:
-                    continue
+    def iterTokens(
+        self,
+        start: int = 0,
+        end: int | None = None,
+        lineNumber: int = 0,
+        openString: OpenString | None = None,
+        closeStrings: bool = True,
+    ):
+        """
+        Scans self.text in a single pass, yielding tokens as
+        they're found.
+
+        start and end limit the scan to a range of whole lines,
+        and lineNumber is how many lines come before start. A scan
+        can only start at a block boundary: outside of a string,
+        unless openString says which string it starts inside of.
+        Once it's done, self.blockStartingTokenType says what
+        block the scan ended in, and self.openCommentStart says
+        whether it ended in a comment block. Without closeStrings,
+        a string left open isn't cut off at the end of the text,
+        but left in self.openString instead.
+
+        Comments are skipped without being scanned. All they
+        leave behind is their command.
+        """
+        text = self.text
+        scanEnd = len(text) if end is None else end
 
-                # not on block? skip whitespace chunks
-                if blockStartingTokenType is None and isWhiteSpace(chunk):
+        blockStartingTokenType: None | BlockTokenType = None
+        openCommentStart: int | None = None
+        openQuote = ""
+        stringStart = 0
+        stringLine = 0
+        isConditionLine = False
+        if openString is not None:
+            blockStartingTokenType = TokenType.StringBlockStart
+            openQuote = openString.quote
+            stringStart = openString.start
+            stringLine = openString.line
+            isConditionLine = openString.isConditionLine
+
+        lineStart = start
+        while lineStart < scanEnd:
+            lineNumber += 1
+            lineEnd = text.find("\n", lineStart, scanEnd)
+            if lineEnd == -1:
+                lineEnd = scanEnd
+            position = lineStart
+            lineStart = lineEnd + 1
+
+            if blockStartingTokenType is TokenType.StringBlockStart:
+                # strings can span multiple lines
+                closingPosition = text.find(openQuote, position, lineEnd)
+                if closingPosition == -1:
                     continue
-
-                # check for commands
-                if isFirstChunkInLine:
-                    chunkIsCommand = chunk in CHUNK_TOKEN_TYPE_MAP["commands"]
-                    if chunkIsCommand:
-                        lineTokens.append(Token(type=TokenType.Command, text=chunk))
-                        continue
-                    isFirstChunkInLine = False
-
-                chunkIsMultilineBlockStart = (
-                    chunk in CHUNK_TOKEN_TYPE_MAP["multilineBlockStart"]
+                yield Token(
+                    TokenType.Literal, text, stringStart, closingPosition, stringLine
                 )
-                chunkFirstCharIsMultilineBlockStart = (
-                    chunk[0] in CHUNK_TOKEN_TYPE_MAP["multilineBlockStart"]
+                yield Token(
+                    TokenType.StringBlockEnd,
+                    text,
+                    closingPosition,
+                    closingPosition + 1,
+                    lineNumber,
                 )
-
-                if chunkIsMultilineBlockStart or chunkFirstCharIsMultilineBlockStart:
-                    lineTokens.append(
-                        Token(type=TokenType.MultilineBlockStart, text=chunk)
-                    )
-                    blockStartingTokenType = TokenType.MultilineBlockStart
-                    continue
-                elif (
-                    chunk in CHUNK_TOKEN_TYPE_MAP["multilineBlockEnd"]
-                    or chunk[-1] in CHUNK_TOKEN_TYPE_MAP["multilineBlockEnd"]
-                ):
-                    lineTokens.append(
-                        Token(type=TokenType.MultilineBlockEnd, text=chunk)
-                    )
-                    blockStartingTokenType = None
+                blockStartingTokenType = None
+                position = closingPosition + 1
+            else:
+                position = WHITESPACE_PATTERN.match(text, position, lineEnd).end()
+                if position == lineEnd:
                     continue
 
-                wholeChunkIsStringBlockStart = (
-                    chunk in CHUNK_TOKEN_TYPE_MAP["stringBlockStart"]
-                )
-                wholeChunkIsStringBlockEnd = (
-                    chunk in CHUNK_TOKEN_TYPE_MAP["stringBlockEnd"]
-                )
-
-                chunkFirstCharIsStringBlockStart = (
-                    chunk[0] in CHUNK_TOKEN_TYPE_MAP["stringBlockStart"]
-                    and not wholeChunkIsStringBlockStart
-                    and not wholeChunkIsStringBlockEnd
-                )
-                chunkLastCharIsStringBlockEnd = (
-                    chunk[-1] in CHUNK_TOKEN_TYPE_MAP["stringBlockEnd"]
-                    and not wholeChunkIsStringBlockStart
-                    and not wholeChunkIsStringBlockEnd
-                )
-
-                if wholeChunkIsStringBlockStart and (
-                    blockStartingTokenType is not TokenType.StringBlockStart
+                # check for comments, then other commands
+                character = text[position]
+                isConditionLine = character == CONDITION_CHARACTER
+                if character == COMMENT_CHARACTER and (
+                    comment := COMMENT_PATTERN.match(text, position, lineEnd)
                 ):
-                    lineTokens.append(
-                        Token(type=TokenType.StringBlockStart, text=chunk)
+                    yield Token(
+                        TokenType.Command, text, position, position + 1, lineNumber
                     )
-                    blockStartingTokenType = TokenType.StringBlockStart
-                    continue
-                elif wholeChunkIsStringBlockEnd:
-                    lineTokens.append(Token(type=TokenType.Literal, text=tokenContent))
-                    lineTokens.append(Token(type=TokenType.StringBlockEnd, text=chunk))
-
-                    blockStartingTokenType = None
-                    tokenContent = ""
-
-                    continue
-
-                if chunkFirstCharIsStringBlockStart:
-                    blockStartingTokenType = TokenType.StringBlockStart
-
-                    foundTokens = []
+                    if comment.group(1) is None:
+                        continue
 
-                    foundTokens.append(
-                        Token(type=blockStartingTokenType, text=chunk[0])
+                    # comment blocks run until a line that's only ";"
+                    blockEnd = COMMENT_BLOCK_END_PATTERN.search(
+                        text, lineStart, scanEnd
                     )
-
-                    if chunkLastCharIsStringBlockEnd:
-                        foundTokens.append(
-                            Token(type=TokenType.Literal, text=chunk[1:-1])
-                        )
-                        foundTokens.append(
-                            Token(type=TokenType.StringBlockEnd, text=chunk[-1])
-                        )
-                        blockStartingTokenType = None
-                    else:
-                        foundTokens.append(
-                            Token(type=TokenType.Literal, text=chunk[1:])
+                    if blockEnd is None:
+                        openCommentStart = (
+                            text.rfind("\n", start, position) + 1 or start
                         )
-                    lineTokens = [*lineTokens, *foundTokens]
-                    continue
-
-                if chunkLastCharIsStringBlockEnd:
-                    blockStartingTokenType = None
+                        break
+                    lineNumber += 1 + text.count("\n", lineStart, blockEnd.start())
+                    position = blockEnd.end()
+                    lineEnd = text.find("\n", position, scanEnd)
+                    if lineEnd == -1:
+                        lineEnd = scanEnd
+                    lineStart = lineEnd + 1
+                elif character in COMMAND_CHARACTERS and (
+                    position + 1 == lineEnd or text[position + 1].isspace()
+                ):
+                    yield Token(
+                        TokenType.Command, text, position, position + 1, lineNumber
+                    )
+                    position += 1
+
+                    # shell lines are passed along as they are
+                    if character == "$":
+                        position = WHITESPACE_PATTERN.match(
+                            text, position, lineEnd
+                        ).end()
+                        shellEnd = lineEnd
+                        while shellEnd > position and text[shellEnd - 1].isspace():
+                            shellEnd -= 1
+                        if shellEnd > position:
+                            yield Token(
+                                TokenType.Literal, text, position, shellEnd, lineNumber
+                            )
+                        continue
 
-                    foundTokens = []
-                    foundTokens.append(
-                        Token(type=TokenType.Literal, text=(tokenContent + chunk[:-1]))
+            while True:
+                position = WHITESPACE_PATTERN.match(text, position, lineEnd).end()
+                if position >= lineEnd:
+                    break
+
+                character = text[position]
+                if character in QUOTE_CHARACTERS:
+                    yield Token(
+                        TokenType.StringBlockStart,
+                        text,
+                        position,
+                        position + 1,
+                        lineNumber,
                     )
-                    foundTokens.append(
-                        Token(
-                            type=TokenType.StringBlockEnd,
-                            text=chunk[-1],
-                        )
+                    closingPosition = text.find(character, position + 1, lineEnd)
+                    if closingPosition == -1:
+                        blockStartingTokenType = TokenType.StringBlockStart
+                        openQuote = character
+                        stringStart = position + 1
+                        stringLine = lineNumber
+                        break
+                    yield Token(
+                        TokenType.Literal,
+                        text,
+                        position + 1,
+                        closingPosition,
+                        lineNumber,
                     )
-                    lineTokens = [*lineTokens, *foundTokens]
-                    blockStartingTokenType = None
-
+                    yield Token(
+                        TokenType.StringBlockEnd,
+                        text,
+                        closingPosition,
+                        closingPosition + 1,
+                        lineNumber,
+                    )
+                    position = closingPosition + 1
                     continue
 
-                if blockStartingTokenType is TokenType.StringBlockStart:
-                    tokenContent += chunk
-                    continue
+                wordStart = position
+                wordEnd = position = WORD_PATTERN.match(text, position, lineEnd).end()
+
+                blockTokenType: None | BlockTokenType = None
+                lastCharacter = text[wordEnd - 1]
+                if lastCharacter == MULTILINE_BLOCK_END:
+                    blockTokenType = TokenType.MultilineBlockEnd
+                    wordEnd -= 1
+                elif lastCharacter == MULTILINE_BLOCK_START and (
+                    wordEnd - wordStart == 1
+                    or isConditionLine
+                    and WHITESPACE_PATTERN.match(text, position, lineEnd).end()
+                    == lineEnd
+                ):
+                    blockTokenType = TokenType.MultilineBlockStart
+                    wordEnd -= 1
 
-                elif isNumber(chunk):
-                    lineTokens.append(Token(type=TokenType.Literal, text=chunk))
-                    continue
-                else:
-                    lineTokens.append(Token(type=TokenType.Reference, text=chunk))
-                    continue
+                if wordEnd > wordStart:
+                    if NUMBER_PATTERN.fullmatch(text, wordStart, wordEnd):
+                        wordType = TokenType.Literal
+                    else:
+                        wordType = TokenType.Reference
+                    yield Token(wordType, text, wordStart, wordEnd, lineNumber)
+
+                if blockTokenType is not None:
+                    yield Token(blockTokenType, text, wordEnd, position, lineNumber)
+                    blockStartingTokenType = (
+                        blockTokenType
+                        if blockTokenType is TokenType.MultilineBlockStart
+                        else None
+                    )
 
-            tokens = [*tokens, *lineTokens]
-        return tokens
+        self.blockStartingTokenType = blockStartingTokenType
+        self.openCommentStart = openCommentStart
+        self.openString = None
+
+        if blockStartingTokenType is TokenType.StringBlockStart:
+            if not closeStrings:
+                self.openString = OpenString(
+                    openQuote, stringStart, stringLine, isConditionLine
+                )
+                return
+            # an unterminated string runs until the end of the text
+            stringEnd = scanEnd
+            if scanEnd > 0 and text[scanEnd - 1] == "\n":
+                stringEnd -= 1
+            yield Token(TokenType.Literal, text, stringStart, stringEnd, stringLine)
+
+
+def iterTokensFromChunks(chunks: Iterable[str]):
+    """
+    Tokenizes text that comes in chunks of whole lines, without
+    ever putting it all together. Tokens point into the chunk
+    they came from.
+
+    A string left open at the end of a chunk is carried over: the
+    chunks after it are only searched for its closing quote, and
+    joined to the one it ends in, which its text has to point into.
+    The lines of a comment block left open are skipped the same way.
+    """
+    lineNumber = 0
+    openString: OpenString | None = None
+    stringParts: list[str] = []
+    inCommentBlock = False
+    chunks = iter(chunks)
+    nextChunk = next(chunks, None)
+    while nextChunk is not None:
+        chunk, nextChunk = nextChunk, next(chunks, None)
+        isLastChunk = nextChunk is None
+        start = 0
+        if inCommentBlock:
+            blockEnd = COMMENT_BLOCK_END_PATTERN.search(chunk)
+            if blockEnd is None:
+                lineNumber += chunk.count("\n")
+                continue
+            inCommentBlock = False
+            lineNumber += 1 + chunk.count("\n", 0, blockEnd.start())
+            start = blockEnd.end() + 1
+        elif openString is not None:
+            if not isLastChunk and openString.quote not in chunk:
+                stringParts.append(chunk)
+                lineNumber += chunk.count("\n")
+                continue
+            stringParts.append(chunk)
+            chunk = "".join(stringParts)
+            start = len(chunk) - len(stringParts[-1])
+            stringParts = []
+
+        tokenizer = Tokenizer(chunk)
+        yield from tokenizer.iterTokens(
+            start, None, lineNumber, openString, closeStrings=isLastChunk
+        )
+        lineNumber += chunk.count("\n", start)
+        openString = tokenizer.openString
+        if openString is not None:
+            stringParts = [chunk[openString.start :]]
+            openString.start = 0
+        inCommentBlock = tokenizer.openCommentStart is not None
@@ -0,0 +1,117 @@
+"""
+Checks that watch's incremental re-reading matches a full parse.
+
+Makes random edits to generated scripts, like inserting lines that
+open strings, comment blocks and ? blocks, deleting lines, and
+typing single characters, and compares IncrementalScript's
+instructions with a fresh parse of the text after every edit.
+
+    python watchcheck.py [seed] [scripts]
+"""
+
+import random
+import sys
+
+from bench import MIXES, generateScript
+from parsing import Instruction, Parser
+from tokenization import Tokenizer
+from watching import IncrementalScript
+
+DEFAULT_SCRIPTS = 300
+EDITS = 20  # per script
+
+# lines worth inserting: most of them open or close something
+INSERTED_LINES = [
+    "/:",
+    ";",
+    "i'll",
+    "/ a comment",
+    '! print "open',
+    '"',
+    "'",
+    "! print 'closed'",
+    "$ echo hi",
+    "% title 1",
+    "! navto folder",
+    "",
+    "  ",
+    ":",
+    "? meta.osType == 'linux':",
+    "word",
+    "! clone 'url' depth 2",
+]
+# characters worth typing into a line
+TYPED_CHARACTERS = ['"', "'", ":", ";", "!", " ", "x", "\n", "$ ", "\r", "\n! "]
+
+
+def describe(instructions: list[Instruction]):
+    """
+    Returns what the instructions say, leaving out their slots,
+    which are numbered differently by an incremental parse.
+    """
+    return [
+        (
+            instruction.commandType,
+            instruction.referenceType,
+            instruction.reference,
+            [
+                (
+                    argument.type,
+                    (
+                        describe(argument.value)
+                        if isinstance(argument.value, list)
+                        else argument.value
+                    ),
+                )
+                for argument in instruction.arguments
+            ],
+            instruction.line,
+        )
+        for instruction in instructions
+    ]
+
+
+def parse(text: str):
+    return describe(Parser(Tokenizer(text).iterTokens()).getInstructions())
+
+
+def editText(generator: random.Random, text: str):
+    lines = text.splitlines(keepends=True)
+    position = generator.randint(0, len(lines))
+    kind = generator.random()
+    if kind < 0.4 or not lines:
+        ending = generator.choice(["\n", "\n", ""])
+        lines.insert(position, generator.choice(INSERTED_LINES) + ending)
+    elif kind < 0.7:
+        del lines[position : position + generator.randint(1, 3)]
+    else:
+        position = min(position, len(lines) - 1)
+        line = lines[position]
+        column = generator.randint(0, len(line))
+        character = generator.choice(TYPED_CHARACTERS)
+        lines[position] = line[:column] + character + line[column:]
+    return "".join(lines)
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    scripts = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SCRIPTS
+    generator = random.Random(seed)
+
+    for scriptNumber in range(scripts):
+        text = generateScript(generator.randint(0, 60), MIXES["mixed"], scriptNumber)
+        script = IncrementalScript(text)
+        for edit in range(EDITS + 1):
+            if edit > 0:
+                text = editText(generator, text)
+                script.update(text)
+            if describe(script.instructions) != parse(text):
+                print(f"mismatch in script {scriptNumber}, after edit {edit}:")
+                print(repr(text))
+                sys.exit(1)
+
+    print(f"ok: {scripts} scripts, {EDITS} edits each")
+
+
+if __name__ == "__main__":
+    main()
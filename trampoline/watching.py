@@ -0,0 +1,283 @@
+import os
+import select
+import struct
+import sys
+import time
+from bisect import bisect_left
+
+from parsing import ArgumentType, Instruction, Parser
+from tokenization import TokenType, Tokenizer
+
+POLL_INTERVAL = 0.25  # seconds
+SETTLE_TIME = 0.05  # seconds to wait for an editor to finish saving
+COMPARE_CHUNK_SIZE = 4096  # characters
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class ScriptChange:
+    def __init__(self, instructions: list[Instruction], lineCount: int):
+        self.instructions: list[Instruction] = instructions  # the re-read ones
+        self.lineCount: int = lineCount  # how many lines were re-read
+
+
+class IncrementalScript:
+    """
+    Keeps a script's instructions up to date as its text changes.
+
+    Every instruction starts at a block boundary, so when some
+    lines change, only the instructions around them are tokenized
+    and parsed again. The rest are kept, with their lines moved.
+    """
+
+    def __init__(self, text: str = ""):
+        self.text: str = ""
+        self.instructions: list[Instruction] = []
+        self.slots: dict[str, int] = {}  # shared, so slots match across updates
+        self.update(text)
+
+    def update(self, text: str):
+        """
+        Brings the instructions up to date with text. Returns a
+        ScriptChange, or None if nothing changed.
+        """
+        oldText = self.text
+
+        # find the text that changed
+        prefixLength = getCommonPrefixLength(oldText, text)
+        if prefixLength == len(oldText) == len(text):
+            return None
+        suffixLength = getCommonSuffixLength(
+            oldText, text, min(len(oldText), len(text)) - prefixLength
+        )
+        oldSuffixStart = len(oldText) - suffixLength
+        changedLine = oldText.count("\n", 0, prefixLength)  # counting from 0
+        lineDelta = text.count("\n", prefixLength, len(text) - suffixLength) - (
+            oldText.count("\n", prefixLength, oldSuffixStart)
+        )
+
+        # start over from the instruction before the changed line,
+        # since the change might add arguments to it
+        firstIndex = self.getInstructionIndex(changedLine) - 1
+        if firstIndex < 0:
+            firstIndex = startLine = 0  # text before the first command counts too
+        else:
+            startLine = self.instructions[firstIndex].line - 1
+        startOffset = getLineStartBefore(text, prefixLength, changedLine - startLine)
+
+        # and stop at the first instruction that starts after the
+        # change, as long as the change doesn't leave a string, a
+        # comment block or a "?" block open
+        suffixLine = changedLine + oldText.count("\n", prefixLength, oldSuffixStart)
+        endIndex = self.getInstructionIndex(suffixLine + 1)
+        while True:
+            endOffset = len(text)
+            if endIndex < len(self.instructions):
+                endLine = self.instructions[endIndex].line - 1
+                endOffset = getLineStartAfter(
+                    oldText, oldSuffixStart, endLine - suffixLine
+                ) + (len(text) - len(oldText))
+
+            tokenizer = Tokenizer(text)
+            tokens = tokenizer.iterTokens(startOffset, endOffset, startLine)
+            parser = Parser(tokens, self.slots)
+            changedInstructions = parser.getInstructions()
+            if endIndex >= len(self.instructions) or (
+                tokenizer.blockStartingTokenType is not TokenType.StringBlockStart
+                and tokenizer.openCommentStart is None
+                and parser.openBlockCount == 0
+            ):
+                break
+            endIndex += 1
+
+        if lineDelta != 0:
+            for index in range(endIndex, len(self.instructions)):
+                moveInstruction(self.instructions[index], lineDelta)
+        self.instructions[firstIndex:endIndex] = changedInstructions
+        self.text = text
+        return ScriptChange(
+            changedInstructions, text.count("\n", startOffset, endOffset)
+        )
+
+    def getInstructionIndex(self, line: int):
+        """
+        Returns the index of the first instruction starting at or
+        after line, counting lines from 0.
+        """
+        return bisect_left(
+            self.instructions, line + 1, key=lambda instruction: instruction.line
+        )
+
+
+def moveInstruction(instruction: Instruction, lineDelta: int):
+    """
+    Moves an instruction, and any inside its block, lineDelta lines.
+    """
+    instruction.line += lineDelta
+    for argument in instruction.arguments:
+        if argument.type is ArgumentType.InstructionSet:
+            for bodyInstruction in argument.value:
+                moveInstruction(bodyInstruction, lineDelta)
+
+
+def getCommonPrefixLength(first: str, second: str):
+    limit = min(len(first), len(second))
+    position = 0
+    # compare whole chunks first, which is much faster than characters
+    while position < limit:
+        end = min(position + COMPARE_CHUNK_SIZE, limit)
+        if first[position:end] != second[position:end]:
+            break
+        position = end
+    while position < limit and first[position] == second[position]:
+        position += 1
+    return position
+
+
+def getCommonSuffixLength(first: str, second: str, limit: int):
+    length = 0
+    while length < limit:
+        chunkLength = min(length + COMPARE_CHUNK_SIZE, limit)
+        if (
+            first[len(first) - chunkLength : len(first) - length]
+            != second[len(second) - chunkLength : len(second) - length]
+        ):
+            break
+        length = chunkLength
+    while length < limit and first[-1 - length] == second[-1 - length]:
+        length += 1
+    return length
+
+
+def getLineStartBefore(text: str, position: int, lineCount: int):
+    """
+    Returns where the line lineCount lines above the one
+    position is in starts.
+    """
+    start = text.rfind("\n", 0, position) + 1
+    for _ in range(lineCount):
+        start = text.rfind("\n", 0, start - 1) + 1
+    return start
+
+
+def getLineStartAfter(text: str, position: int, lineCount: int):
+    """
+    Returns where the line lineCount lines below the one
+    position is in starts.
+    """
+    start = position
+    for _ in range(lineCount):
+        start = text.find("\n", start) + 1
+        if start == 0:
+            return len(text)
+    return start
+
+
+class PollingWatcher:
+    """
+    Notices changes to a file by checking on it every so often.
+    """
+
+    def __init__(self, path: str, interval: float = POLL_INTERVAL):
+        self.path: str = path
+        self.interval: float = interval
+        self.signature = self.getSignature()
+
+    def getSignature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def wait(self):
+        """
+        Blocks until the file changes.
+        """
+        while True:
+            time.sleep(self.interval)
+            signature = self.getSignature()
+            if signature != self.signature and signature is not None:
+                self.signature = signature
+                return
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Notices changes to a file through Linux's inotify. It watches
+    the file's folder, since editors often save by replacing files.
+    """
+
+    def __init__(self, path: str):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.name: bytes = os.path.basename(path).encode()
+
+        self.fileDescriptor: int = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fileDescriptor < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        directory = os.path.dirname(os.path.abspath(path)).encode()
+        if self.libc.inotify_add_watch(self.fileDescriptor, directory, mask) < 0:
+            os.close(self.fileDescriptor)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def readEvents(self, timeout: float | None):
+        """
+        Returns whether any of the events that showed up within
+        timeout seconds were about the file.
+        """
+        readable, _, _ = select.select([self.fileDescriptor], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            data = os.read(self.fileDescriptor, 64 * 1024)
+        except BlockingIOError:
+            return False
+
+        changed = False
+        position = 0
+        while position + INOTIFY_EVENT.size <= len(data):
+            _, _, _, nameLength = INOTIFY_EVENT.unpack_from(data, position)
+            position += INOTIFY_EVENT.size
+            name = data[position : position + nameLength].rstrip(b"\0")
+            position += nameLength
+            changed = changed or name == self.name
+        return changed
+
+    def wait(self):
+        """
+        Blocks until the file changes, and the changes settle.
+        """
+        while not self.readEvents(None):
+            pass
+        while self.readEvents(SETTLE_TIME):
+            pass
+
+    def close(self):
+        os.close(self.fileDescriptor)
+
+
+def getWatcher(path: str, interval: float = POLL_INTERVAL):
+    """
+    Returns an inotify watcher where there's inotify, and a
+    polling one everywhere else.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(path, interval)